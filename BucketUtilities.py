@@ -5,28 +5,20 @@ The following code contains all the routines used in the analysis of the 2D buck
 """
 from __future__ import print_function
 
+import os
+import os.path as op
+import re
+import functools
+import unittest
+from glob import glob
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 
 NETMODE = 'standard' # cru / standard / mieux / encore
-def loadInt2D(epath, net=False, sym=False):
-    """loads intensities from a csv bucket-list file from 2D spectra
-    net: determines whether the cleaning method is used
-        the method used is defined by NETMODE global
-    sym: whether symetrisation is used
-    """
-    # lit le fichier
-    ne1 = pd.read_csv( epath, header=1, sep = ', ', usecols=[0, 1, 2], engine='python')
-    x1 = np.array(ne1['centerF1'])
-    xu1 = np.unique(x1)
-    y1 = np.array(ne1['centerF2'])
-    yu1 = np.unique(y1)
-    z1 = np.array(ne1['bucket'])
-    # calcul la matrice
-    Xr1, Yr1 = np.meshgrid(yu1, xu1)
-    Zr1 = np.reshape(z1,(len(xu1),len(yu1)))
+def _clean(Zr1, net, sym):
+    """applies the cleaning method defined by NETMODE if net is True, and symetrisation if sym is True"""
     netmode = NETMODE
     if net:
         if netmode=='standard':
@@ -38,39 +30,111 @@ def loadInt2D(epath, net=False, sym=False):
         elif netmode != 'cru':
             raise Exception(netmode + ' : Wrong netmode !')
     if sym:
-            Zr1 = symetrise(Zr1)
-    return [Xr1, Yr1, np.nan_to_num(Zr1)]
+        Zr1 = symetrise(Zr1)
+    return Zr1
+
+CACHESIZE = 32      # number of bucket-lists kept in memory by readBucket2D()
+def readBucket2D(epath):
+    """reads all the columns of a 2D bucket-list file (csv or npz) in a single pass
+    returns a dictionary of (nF1, nF2) grids: 'X' and 'Y' the F2 and F1 bucket centers,
+        then one entry per column: 'bucket', 'max', 'min', 'std', ...
+    results are cached (keyed by file modification time), so that repeated loads are free,
+    the returned arrays are read-only
+    """
+    return _readBucket2D(op.abspath(epath), op.getmtime(epath))
+
+@functools.lru_cache(maxsize=CACHESIZE)
+def _readBucket2D(epath, mtime):
+    "does the work for readBucket2D() - mtime is only used as a cache key"
+    if epath.endswith('.npz'):
+        with np.load(epath) as F:
+            Xr1, Yr1 = np.meshgrid(F['centerF2'], F['centerF1'])
+            if 'row' in F.files:
+                grids = densify(F)
+            else:
+                grids = {col: F[col] for col in F['columns'] if F[col].ndim == 2}
+    else:
+        ne1 = pd.read_csv( epath, header=1, skipinitialspace=True)    # C engine
+        x1 = ne1['centerF1'].values
+        # rows are ordered F1 major, so nF2 is the length of the first run of F1 values
+        change = np.nonzero(x1 != x1[0])[0]
+        n2 = change[0] if len(change) > 0 else len(x1)
+        n1 = len(x1)//n2
+        Xr1, Yr1 = np.meshgrid(ne1['centerF2'].values[:n2], x1[::n2])
+        grids = {col: np.reshape(ne1[col].values, (n1, n2)) for col in ne1.columns}
+    grids['X'] = Xr1
+    grids['Y'] = Yr1
+    for v in grids.values():
+        v.setflags(write=False)
+    return grids
+
+AXISCOLUMNS = ('centerF1', 'centerF2', 'bucket_size_F1', 'bucket_size_F2')
+def densify(F, fill=None):
+    """builds the full (nF1, nF2) grids of a sparse 2D bucket list - as produced by bucket2d(sparse=...)
+    F is the npz content, as returned by np.load()
+    the buckets which were not stored are set to fill[column],
+        by default the noise floor for 'std' and 0.0 for all other columns
+    returns a dictionary of grids, one per column
+    """
+    if fill is None:
+        fill = {'std': float(F['noise'])}
+    shape = (len(F['centerF1']), len(F['centerF2']))
+    row, col = F['row'], F['col']
+    grids = {}
+    for name in F['columns']:
+        if name in AXISCOLUMNS:
+            continue
+        Z = np.full(shape, fill.get(name, 0.0))
+        Z[row, col] = F[name]
+        grids[name] = Z
+    return grids
+
+def load2D(epath, column='bucket', net=False, sym=False):
+    """loads a given column from a bucket-list file (csv or npz) from 2D spectra
+    column: the value to load, 'bucket' (intensities), 'max', 'min', 'std', ...
+    net: determines whether the cleaning method is used
+        the method used is defined by NETMODE global
+    sym: whether symetrisation is used
+    returns [X, Y, Z] grids
+    """
+    grids = readBucket2D(epath)
+    Zr1 = _clean(grids[column], net, sym)
+    return [grids['X'], grids['Y'], np.nan_to_num(Zr1)]
+
+def loadInt2D(epath, net=False, sym=False):
+    """loads intensities from a csv bucket-list file from 2D spectra
+    net: determines whether the cleaning method is used
+        the method used is defined by NETMODE global
+    sym: whether symetrisation is used
+    npz bucket-lists are also accepted
+    """
+    return load2D(epath, 'bucket', net=net, sym=sym)
     
 def loadStd2D(epath, net=False, sym=False):
     """loads std from a csv bucket-list file from 2D spectra
     net: determines whether the cleaning method is used
         the method used is defined by NETMODE global
     sym: whether symetrisation is used
+    npz bucket-lists are also accepted
     """
-    # lit le fichier
-    ne1 = pd.read_csv( epath, header=1, sep = ', ', usecols=[0, 1, 5], engine='python')
-    x1 = np.array(ne1['centerF1'])
-    xu1 = np.unique(x1)
-    y1 = np.array(ne1['centerF2'])
-    yu1 = np.unique(y1)
-    z1 = np.array(ne1['std'])
-    # calcul la matrice
-    Xr1, Yr1 = np.meshgrid(yu1, xu1)
-    Zr1 = np.reshape(z1,(len(xu1),len(yu1)))
-    netmode = NETMODE
-    if net:
-        if netmode=='standard':
-            Zr1 = nettoie(Zr1)
-        elif netmode=='mieux':
-            Zr1 = nettoie_mieux(Zr1)
-        elif netmode=='encore':
-            Zr1 = nettoie_encore_mieux(Zr1)
-        elif netmode != 'cru':
-            raise Exception(netmode + ' : Wrong netmode !')
-    if sym:
-        Zr1 = symetrise(Zr1)
-    return [Xr1, Yr1, np.nan_to_num(Zr1)]
-    
+    return load2D(epath, 'std', net=net, sym=sym)
+
+def loadnpz2D(epath, column='bucket', net=False, sym=False):
+    """loads a npz bucket-list file from 2D spectra - as produced by bucket2d(format='npz')
+    column: the value to load, 'bucket' (intensities), 'max', 'min', 'std', ...
+    net, sym: as in loadInt2D()
+    returns the same [X, Y, Z] grids as loadInt2D(), values are not rounded
+    """
+    return load2D(epath, column, net=net, sym=sym)
+
+def loadnpz1D(epath, column='bucket'):
+    """loads a npz bucket-list file from 1D spectra - as produced by bucket1d(format='npz')
+    column: the value to load, 'bucket' (intensities), 'max', 'min', 'std', ...
+    returns [X, Z] where X are the bucket centers
+    """
+    with np.load(epath) as F:
+        return [F['center'], np.nan_to_num(F[column])]
+
 def affiche(X, Y, Z, scale=1.0, ax=None, cmap=None, figsize=(8, 7), reverse=True):
     "draw the 2D bucket list"
     if ax is None:
@@ -97,22 +161,33 @@ def nettoie(ZZ, factor=2.0):
     print( thresh)
     ZZr[ZZ<thresh] = 1.0   # 1.0 allows to display log(Z) !
     return ZZr
-def nettoie_mieux(ZZ, factor=2.0):
-    " clean noise in matrix - hard thresholding columnwise"
-    ZZr = ZZ.copy()
-    for i in range(ZZ.shape[1]):
-        iZZ = ZZ[:,i]
-        thresh = factor*np.median(iZZ)
-        ZZr[iZZ<thresh,i] = 1.0
-    return ZZr
-def nettoie_encore_mieux(ZZ, factor=2.0):
-    " clean noise in matrix - soft thresholding columnwise"
-    ZZr = ZZ.copy()
-    for i in range(ZZ.shape[1]):
-        iZZ = ZZ[:,i]
-        thresh = factor*np.median(iZZ)
-        ZZr[:,i] = np.where(iZZ<thresh, 1, iZZ-thresh+1) 
+def _columnwise(ZZ, factor, chunk, soft):
+    """ thresholding columnwise, used by nettoie_mieux() and nettoie_encore_mieux()
+    ZZ is (F1, F2) or (n_samples, F1, F2), medians are computed along F1, separately for each sample
+    """
+    def clean(B):
+        thresh = factor*np.median(B, axis=-2, keepdims=True)
+        if soft:
+            return np.where(B<thresh, 1, B-thresh+1)
+        return np.where(B<thresh, 1.0, B)
+    if ZZ.ndim == 2 or chunk is None:
+        return clean(ZZ).astype(ZZ.dtype, copy=False)
+    ZZr = np.empty(ZZ.shape, dtype=ZZ.dtype)
+    for i in range(0, ZZ.shape[0], chunk):
+        ZZr[i:i+chunk] = clean(ZZ[i:i+chunk])
     return ZZr
+def nettoie_mieux(ZZ, factor=2.0, chunk=None):
+    """ clean noise in matrix - hard thresholding columnwise
+    ZZ is either a matrix, or a stack of matrices (n_samples, F1, F2) each cleaned independently
+    chunk: if given, a stack is processed by chunks of this number of samples, to limit memory usage
+    """
+    return _columnwise(ZZ, factor, chunk, soft=False)
+def nettoie_encore_mieux(ZZ, factor=2.0, chunk=None):
+    """ clean noise in matrix - soft thresholding columnwise
+    ZZ is either a matrix, or a stack of matrices (n_samples, F1, F2) each cleaned independently
+    chunk: if given, a stack is processed by chunks of this number of samples, to limit memory usage
+    """
+    return _columnwise(ZZ, factor, chunk, soft=True)
 def compare(name, scale=1.0):
     " load and compare 2 2D bucketlists"
     g = loadStd2D(name, net=False, sym=False)
@@ -133,4 +208,245 @@ def normalize(Z):
     ZZ = np.log(Z)
     mu = ZZ.mean()
     sigma = ZZ.std()
-    
\ No newline at end of file
+    
+
+# bucket lists are named TYPE_expno_bucketlist[_size].csv or .npz
+BUCKETLIST = re.compile(r'^(?P<type>[^_]+)_(?P<expno>[^_]+)_bucketlist(?P<size>.*)\.(csv|npz)$')
+def build_tensors(resdir, storedir, column='bucket'):
+    """assembles all the 2D bucket-lists of a run into one tensor per experiment type
+    resdir: the Results folder, containing Results/sample/2D/TYPE_expno_bucketlist.csv (or .npz)
+    storedir: the folder where the tensors are stored
+    column: 'bucket' for intensities, 'std' for standard deviations
+    for each experiment type (and bucket size if several were computed), creates
+        TYPE.npy : a (n_samples, n_F1, n_F2) array, to be opened with loadTensor()
+        TYPE_index.csv : the sample and expno of each entry of the tensor
+        TYPE_axes.npz : the F1 and F2 bucket centers
+    bucket-lists with a grid different from the first one found are skipped
+    returns the list of the created tensor names
+    """
+    loader = {'bucket': loadInt2D, 'std': loadStd2D}[column]
+    groups = {}
+    for f2d in sorted(glob(op.join(resdir, '*', '2D', '*_bucketlist*'))):
+        m = BUCKETLIST.match(op.basename(f2d))
+        if m is None:
+            continue
+        manip = op.basename(op.dirname(op.dirname(f2d)))
+        groups.setdefault(m.group('type')+m.group('size'), []).append((manip, m.group('expno'), f2d))
+    if groups and not op.isdir(storedir):
+        os.makedirs(storedir)
+    for name, entries in groups.items():
+        X, Y, Z = loader(entries[0][2])
+        shape = Z.shape
+        T = np.lib.format.open_memmap(op.join(storedir, name+'.npy'), mode='w+', dtype=float, shape=(len(entries),)+shape)
+        index = []
+        for manip, expno, f2d in entries:
+            if len(index) > 0:
+                Z = loader(f2d)[2]
+            if Z.shape != shape:
+                print("*** %s: bucket grid %s differs from %s, skipped"%(f2d, Z.shape, shape))
+                continue
+            T[len(index)] = Z
+            index.append((manip, expno, op.basename(f2d)))
+        T.flush()
+        del T
+        if len(index) < len(entries):       # trim skipped entries, sample by sample, without loading the tensor
+            fname = op.join(storedir, name+'.npy')
+            tmp = fname + '.tmp'
+            T = np.load(fname, mmap_mode='r')
+            Tt = np.lib.format.open_memmap(tmp, mode='w+', dtype=float, shape=(len(index),)+shape)
+            for i in range(len(index)):
+                Tt[i] = T[i]
+            Tt.flush()
+            del T, Tt
+            os.replace(tmp, fname)
+        with open(op.join(storedir, name+'_index.csv'), 'w') as F:
+            print("# %s tensor index"%(name,), file=F)
+            print("row, manip, expno, file", file=F)
+            for i, (manip, expno, fname) in enumerate(index):
+                print(i, manip, expno, fname, sep=', ', file=F)
+        np.savez(op.join(storedir, name+'_axes.npz'), centerF1=Y[:,0], centerF2=X[0,:])
+        print("%s tensor: %d samples x %d x %d buckets"%(name, len(index), shape[0], shape[1]))
+    return list(groups.keys())
+
+def loadTensor(storedir, name):
+    """opens a tensor built by build_tensors(), without loading it in memory
+    returns [T, index, X, Y]
+        T: a read-only memory-mapped (n_samples, n_F1, n_F2) array
+        index: a list of (manip, expno) one per entry of T
+        X, Y: the bucket center grids, as returned by loadInt2D()
+    so that affiche(X, Y, T[i]) displays the ith sample
+    """
+    T = np.load(op.join(storedir, name+'.npy'), mmap_mode='r')
+    ind = pd.read_csv(op.join(storedir, name+'_index.csv'), header=1, skipinitialspace=True)    # C engine
+    index = list(zip(ind['manip'], ind['expno']))
+    with np.load(op.join(storedir, name+'_axes.npz')) as F:
+        X, Y = np.meshgrid(F['centerF2'], F['centerF1'])
+    return [T, index, X, Y]
+
+class BucketUtilitiesTests(unittest.TestCase):
+    "tests of the bucket-list loaders and cleaning tools"
+    def _lists(self, dirname, name='HSQC_3', n1=6, n2=5, seed=0):
+        """writes the same 2D bucket list in csv and npz in dirname, as bucket2d() would produce them,
+        returns their paths and the (n1, n2) grids"""
+        rs = np.random.RandomState(seed)
+        c1 = np.linspace(120.0, 10.0, n1)
+        c2 = np.linspace(9.0, 0.5, n2)
+        grids = {'bucket': np.round(rs.rand(n1, n2)*1000, 1),
+                 'max': np.round(rs.rand(n1, n2)*100, 1),
+                 'min': np.round(-rs.rand(n1, n2)*10, 1),
+                 'std': np.round(rs.rand(n1, n2)*10+1, 1)}
+        columns = ['centerF1', 'centerF2', 'bucket', 'max', 'min', 'std', 'bucket_size_F1', 'bucket_size_F2']
+        C1, C2 = np.meshgrid(c1, c2, indexing='ij')
+        res = np.stack([C1, C2] + [grids[c] for c in columns[2:6]] + [np.full((n1, n2), 4), np.full((n1, n2), 3)], axis=-1)
+        res = res.reshape(n1*n2, len(columns))
+        paths = {'csv': op.join(dirname, name+'_bucketlist.csv'), 'npz': op.join(dirname, name+'_bucketlist.npz')}
+        with open(paths['csv'], 'w') as F:
+            print("# %d rectangular buckets"%(n1*n2), file=F)
+            print(", ".join(columns), file=F)
+            np.savetxt(F, res, fmt="%.3f, %.3f, %.1f, %.1f, %.1f, %.1f, %d, %d")
+        meta = {'centerF1': c1, 'centerF2': c2, 'bucket_size_F1': np.full(n1, 4), 'bucket_size_F2': np.full(n2, 3),
+                'columns': np.array(columns)}
+        np.savez(paths['npz'], **dict(meta, **grids))
+        return paths, C2, C1, grids
+
+    def test_loaders(self):
+        "csv and npz bucket lists load to the same grids"
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp:
+            paths, X, Y, grids = self._lists(tmp)
+            for column in ('bucket', 'std', 'max'):
+                for fmt in ('csv', 'npz'):
+                    Xl, Yl, Zl = load2D(paths[fmt], column)
+                    self.assertTrue(np.allclose(Xl, X) and np.allclose(Yl, Y))
+                    self.assertTrue(np.allclose(Zl, grids[column]))
+                self.assertTrue(np.allclose(loadnpz2D(paths['npz'], column)[2], grids[column]))
+            self.assertTrue(np.array_equal(loadInt2D(paths['csv'])[2], load2D(paths['csv'], 'bucket')[2]))
+            self.assertTrue(np.array_equal(loadStd2D(paths['npz'])[2], grids['std']))
+
+    def test_nettoie(self):
+        "columnwise cleaning gives the results of the former column by column code, on matrices and stacks"
+        def old_mieux(ZZ, factor=2.0):
+            ZZr = ZZ.copy()
+            for i in range(ZZ.shape[1]):
+                iZZ = ZZ[:,i]
+                thresh = factor*np.median(iZZ)
+                ZZr[iZZ<thresh,i] = 1.0
+            return ZZr
+        def old_encore_mieux(ZZ, factor=2.0):
+            ZZr = ZZ.copy()
+            for i in range(ZZ.shape[1]):
+                iZZ = ZZ[:,i]
+                thresh = factor*np.median(iZZ)
+                ZZr[:,i] = np.where(iZZ<thresh, 1, iZZ-thresh+1)
+            return ZZr
+        rs = np.random.RandomState(3)
+        stack = rs.rand(7, 40, 30)**4*100
+        for new, old in ((nettoie_mieux, old_mieux), (nettoie_encore_mieux, old_encore_mieux)):
+            for factor in (2.0, 3.5):
+                self.assertTrue(np.array_equal(new(stack[0], factor), old(stack[0], factor)))
+                ref = np.array([old(Z, factor) for Z in stack])
+                for chunk in (None, 1, 3, 10):
+                    self.assertTrue(np.array_equal(new(stack, factor, chunk=chunk), ref))
+
+
+    def test_tensors(self):
+        "build_tensors() assembles the bucket lists of all samples, loadTensor() reads them back"
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp:
+            resdir = op.join(tmp, 'Results')
+            grids = {}
+            for i, manip in enumerate(('sampleA', 'sampleB', 'sampleC')):
+                d2 = op.join(resdir, manip, '2D')
+                os.makedirs(d2)
+                paths, X, Y, grids[manip] = self._lists(d2, seed=i)
+                os.remove(paths['npz'])                             # one list per experiment
+                os.remove(self._lists(d2, name='COSY_4', n2=(7 if manip == 'sampleB' else 5), seed=10+i)[0]['npz'])
+            storedir = op.join(tmp, 'tensors')
+            names = build_tensors(resdir, storedir)
+            self.assertEqual(sorted(names), ['COSY', 'HSQC'])
+            T, index, X, Y = loadTensor(storedir, 'HSQC')
+            self.assertEqual(T.shape, (3, 6, 5))
+            self.assertEqual(index, [('sampleA', 3), ('sampleB', 3), ('sampleC', 3)])
+            for i, (manip, expno) in enumerate(index):
+                self.assertTrue(np.allclose(T[i], grids[manip]['bucket']))
+            Xl, Yl, Zl = loadInt2D(op.join(resdir, 'sampleA', '2D', 'HSQC_3_bucketlist.csv'))
+            self.assertTrue(np.allclose(X, Xl) and np.allclose(Y, Yl))
+            # sampleB has a different grid, it is skipped and the tensor is trimmed
+            T, index, X, Y = loadTensor(storedir, 'COSY')
+            self.assertEqual(T.shape, (2, 6, 5))
+            self.assertEqual([manip for manip, expno in index], ['sampleA', 'sampleC'])
+            self.assertTrue(isinstance(T, np.memmap))
+            self.assertTrue(np.allclose(T[1], loadInt2D(op.join(resdir, 'sampleC', '2D', 'COSY_4_bucketlist.csv'))[2]))
+            self.assertFalse(op.exists(op.join(storedir, 'COSY.npy.tmp')))
+            build_tensors(resdir, storedir, column='std')
+            T, index, X, Y = loadTensor(storedir, 'HSQC')
+            self.assertTrue(np.allclose(T[1], grids['sampleB']['std']))
+
+    def test_cache(self):
+        "readBucket2D() reads all the columns in one pass, and caches them until the file changes"
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp:
+            paths, X, Y, grids = self._lists(tmp)
+            for fmt in ('csv', 'npz'):
+                G = readBucket2D(paths[fmt])
+                for column in ('bucket', 'max', 'min', 'std'):
+                    self.assertTrue(np.allclose(G[column], grids[column]))
+                self.assertTrue(np.allclose(G['X'], X) and np.allclose(G['Y'], Y))
+                self.assertTrue(readBucket2D(paths[fmt]) is G)      # cached
+                self.assertRaises(ValueError, G['bucket'].fill, 0.0)    # cached grids are read-only
+            self.assertTrue(np.array_equal(readBucket2D(paths['csv'])['bucket_size_F1'], np.full((6, 5), 4)))
+            G = readBucket2D(paths['csv'])
+            self._lists(tmp, seed=1)                    # a new version of the file is read again
+            os.utime(paths['csv'], (op.getmtime(paths['csv'])+10,)*2)
+            G2 = readBucket2D(paths['csv'])
+            self.assertFalse(G2 is G)
+            self.assertFalse(np.allclose(G2['bucket'], G['bucket']))
+
+    def test_sparse(self):
+        "sparse npz lists written by bucket2d() load to full grids, and are picked up by build_tensors()"
+        import tempfile, inspect
+        try:
+            from spike.NMR import NMRData
+            if 'sparse' not in inspect.signature(NMRData.bucket2d).parameters:
+                raise AttributeError
+        except (ImportError, AttributeError):
+            self.skipTest("requires spike with the Bucketing-Plasmodesma plugin")
+        zoom, bsize = ((0.3, 9.5), (0.2, 9.7)), (0.3, 0.1)
+        with tempfile.TemporaryDirectory() as tmp:
+            resdir = op.join(tmp, 'Results')
+            for seed, manip in enumerate(('sampleA', 'sampleB')):
+                rs = np.random.RandomState(seed)
+                b = rs.randn(64, 256)
+                for k in range(12):
+                    i, j = rs.randint(64), rs.randint(256)
+                    b[max(0, i-3):i+3, max(0, j-3):j+3] += 100*rs.rand()
+                d = NMRData(buffer=b)
+                for ax in (d.axis1, d.axis2):
+                    ax.frequency, ax.specwidth, ax.offset = 400.0, 4000.0, 0.0
+                d2 = op.join(resdir, manip, '2D')
+                os.makedirs(d2)
+                name = op.join(d2, 'HSQC_3')
+                with open(name+'_bucketlist.npz', 'wb') as F:     # as Plasmodesma open_bucketlist(name, format='npz')
+                    d.bucket2d(zoom=zoom, bsize=bsize, file=F, format='npz', sparse=20, noise=2.0)
+                if seed == 0:
+                    dense = op.join(tmp, 'dense_bucketlist.npz')
+                    with open(dense, 'wb') as F:
+                        d.bucket2d(zoom=zoom, bsize=bsize, file=F, format='npz')
+            sparse = op.join(resdir, 'sampleA', '2D', 'HSQC_3_bucketlist.npz')
+            with np.load(sparse) as F:
+                self.assertTrue('row' in F.files)
+                kept = np.zeros((len(F['centerF1']), len(F['centerF2'])), dtype=bool)
+                kept[F['row'], F['col']] = True
+                self.assertTrue(np.all(densify(F, fill={'bucket': -1.0})['bucket'][~kept] == -1.0))
+            self.assertTrue(0 < kept.sum() < kept.size)
+            for column in ('bucket', 'max', 'min', 'std'):
+                Xs, Ys, Zs = load2D(sparse, column)
+                Xd, Yd, Zd = load2D(dense, column)
+                self.assertTrue(np.array_equal(Xs, Xd) and np.array_equal(Ys, Yd))
+                self.assertTrue(np.array_equal(Zs[kept], Zd[kept]))
+                self.assertTrue(np.all(Zs[~kept] == (2.0 if column == 'std' else 0.0)))    # noise floor for std
+            storedir = op.join(tmp, 'tensors')
+            self.assertEqual(build_tensors(resdir, storedir), ['HSQC'])
+            T, index, X, Y = loadTensor(storedir, 'HSQC')
+            self.assertEqual(index, [('sampleA', 3), ('sampleB', 3)])
+            self.assertTrue(np.array_equal(T[0], loadInt2D(sparse)[2]))
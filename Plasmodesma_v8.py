@@ -109,9 +109,29 @@ Config = {
     'SANERANK' : 20,        # used for denoising of 2D experiments, sane is an improved version of urQRd
                             # typically 10-50 form homo2D; 5-15 for HSQC, setting to 0 deactivates denoising
                             # takes time !  and time is proportional to SANERANK (hint more is not better !)
+    'SANE_PRECISION' : 'double', # precision of sane computation, either 'double' or 'single'
+                            # 'single' is faster and uses half the memory, and is largely sufficient for bucketing
+    'SANE_MINISNR' : 0,     # if > 0, columns with a first point below SANE_MINISNR x noise are considered as noise, and not denoised
+                            # saves time on COSY/HSQC where most columns are empty, typically 3 to 5 - 0 deactivates
+    'SANE_SKIPPED' : 'keep', # what to do with the columns not denoised, either 'keep' them as they are, or 'zero' them
+    'SANE_SEED' : 0,        # seed of the random projections used by sane, makes two runs on the same data give identical results
+                            # set to None (null in json) to draw different projections at each run
+    'SANE_SHARED_OMEGA' : False, # if True, the same random projections are used for all the columns of a 2D - faster
+    'FFT_BACKEND' : 'scipy', # FFT used by sane and all the processing, either 'numpy', 'scipy' or 'pyfftw' (if installed)
+    'FFT_THREADS' : 0,      # number of threads used by each FFT ('scipy' and 'pyfftw' only)
+                            # 0 is automatic: processors not used by parallel processing are shared among the running experiments
     'DOSY_LAZY' : False,    # if True, will not reprocess DOSY experiment if an already processed file is on the disk
     'PALMA_ITER' : 20000,   # used for processing of DOSY
+    'PALMA_SOLVER' : 'woodbury', # how PALMA applies inv(Id + K.t K), either 'dense' (NxN matrix) or 'woodbury' (MxM factor, faster)
+    'PALMA_CACHE' : True,   # if True, PALMA matrices are computed once per DOSY calibration and stored in the PalmaCache folder
+    'PALMA_WARM' : 0,       # if > 0, DOSY columns are processed along F2 in runs of at most PALMA_WARM columns,
+                            # each one starting from the solution of its neighbour - fewer iterations, e.g. 8
+    'INPLACE_2D' : False,   # if True, 2D analysis (smoothing, peak-picking, bucketing) works directly on the processed spectrum
+                            # this saves a full spectrum of memory per process, processed.gs2 is then saved before analysis
+                            # but the displayed spectra are the smoothed ones
     'BCK_1H_1D' : 0.01,     # bucket size for 1D 1H
+                            # all BCK_* sizes may be given as a list, eg [0.01, 0.02, 0.04]
+                            # one bucket list is then computed for each value, in a single pass
     'BCK_1H_2D' : 0.03,     # bucket size for 2D 1H
     'BCK_1H_LIMITS' : [0.5, 9.5],   # limits of zone to  bucket and display in 1H
     'BCK_13C_LIMITS' : [-10, 150],  # limits of zone to  bucket and display in 13C
@@ -123,6 +143,15 @@ Config = {
     'BCK_DOSY' : 0.1,       # bucket size for vertical axis of DOSY experiments
     'BCK_PP' : False,       # if True computes number of peaks per bucket (different from global peak-picking)
     'BCK_SK' : False,       # if True computes skewness and kurtosis over each bucket
+    'BCK_FORMAT' : 'csv',   # format of the bucket lists, either 'csv' (text) or 'npz' (binary numpy, full precision)
+    'BCK_SPARSE' : 0,       # if > 0, HSQC and HMBC bucket lists only store the buckets above BCK_SPARSE x noise
+                            # as sparse npz files, whatever BCK_FORMAT (see BucketUtilities.densify() )
+    'BCK_REFERENCE' : {},   # adaptive bucketing - maps an experiment type ('1H', '19F', 'COSY', 'TOCSY', 'HSQC', 'HMBC')
+                            # to a reference processed spectrum, relative to the data directory, eg {"1H": "ref/10/processed.gs1"}
+                            # bucket edges are then placed at the minima of the reference, and used for all the series
+    'BCK_MAPS' : True,      # if True, bucket boundaries are computed once per calibration and stored in the BucketMaps folder
+    'BCK_TENSORS' : True,   # if True, all 2D bucket lists are assembled at the end into one sample x bucket tensor
+                            # per experiment type, stored in the Tensors folder (see BucketUtilities.loadTensor() )
     'TITLE': False,         # if true, the title file will be parsed for standard values (see documentation in Bruker_Report.py)
     'PNG': True,            # Figures of computed spectra are stored as PNG files
     'PDF': False,           # Figures of computed spectra are stored as PDF files
@@ -188,6 +217,7 @@ import spike.plugins.Peaks as Peaks
 from spike.Algo.BC import correctbaseline # Necessary for the baseline correction
 from spike.NPKData import as_cpx
 from spike.util.signal_tools import findnoiselevel
+from spike.util import fftbackend
 from spike.Algo.Linpredic import baselinerollrem
 from spike.v1 import Nucleus
 
@@ -222,6 +252,59 @@ def _unpickle_method(func_name, obj, cls):
             break
     return func.__get__(obj, cls)
 
+def aslist(value):
+    "BCK_* sizes can be given either as a single value or as a list of values"
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+def open_bucketlist(name, suffix='', format=None):
+    "opens the bucket list file, with the extension and mode corresponding to format - BCK_FORMAT by default"
+    if format is None:
+        format = RunConfig['BCK_FORMAT']
+    if format == 'npz':
+        return open( name+'_bucketlist'+suffix+'.npz' , 'wb')
+    return open( name+'_bucketlist'+suffix+'.csv' , 'w')
+
+def run_dir(name):
+    "the data directory DIREC, from a bucket list basename: DIREC/Results/sample/xD/expname"
+    return op.dirname(op.dirname(op.dirname(op.dirname(name))))
+
+def bucketmap_dir(name):
+    "the folder holding the bucket boundaries, next to Results - None if BCK_MAPS is off"
+    if not RunConfig['BCK_MAPS']:
+        return None
+    return op.join(run_dir(name), 'BucketMaps')
+
+def palma_cache_dir(resdir):
+    "the folder holding the PALMA matrices, next to Results - None if PALMA_CACHE is off"
+    if not RunConfig['PALMA_CACHE']:
+        return None
+    return op.join(op.dirname(op.dirname(resdir)), 'PalmaCache')
+
+REFMAPS = {}    # adaptive bucket maps, computed once per process from the BCK_REFERENCE spectra
+def reference_map(name, exptype, zoom, bsize):
+    """
+    the adaptive buckets computed on the BCK_REFERENCE spectrum of exptype - None if there is none
+    name is the bucket list basename, used to locate the data directory
+    """
+    reference = RunConfig['BCK_REFERENCE'].get(exptype)
+    if reference is None:
+        return None
+    key = (exptype, repr(zoom), repr(bsize))
+    if key not in REFMAPS:
+        ref = npkd.NMRData(name=op.join(run_dir(name), reference))
+        REFMAPS[key] = ref.adaptive_buckets(zoom=zoom, bsize=bsize)
+    return REFMAPS[key]
+
+def first_line(fname):
+    "returns the first line of a csv file, or the stored header of a npz bucket list"
+    if fname.endswith('.npz'):
+        with np.load(fname) as F:
+            return str(F['header'])+'\n'
+    with open(fname,'r') as F:
+        return F.readline()
+
 def mkdir(f):
     "If a folder doesn't exist it is created"
     if not op.exists(f):
@@ -468,13 +551,23 @@ def analyze_1D(d, name, pplevel=50):
     d.peaks.report(f=d.axis1.itop, file=pkout)
     pkout.close()
 
-    bkout = open( name+'_bucketlist.csv' , 'w')
-
     if (findNuc(d) == '19F'):
-        d.bucket1d(file=bkout, zoom=RunConfig['BCK_19F_LIMITS'], bsize=RunConfig['BCK_19F_1D'], pp=RunConfig['BCK_PP'], sk=RunConfig['BCK_SK'])
+        nuc, zoom, bsizes = '19F', RunConfig['BCK_19F_LIMITS'], aslist(RunConfig['BCK_19F_1D'])
     else:
-        d.bucket1d(file=bkout, zoom=RunConfig['BCK_1H_LIMITS'], bsize=RunConfig['BCK_1H_1D'], pp=RunConfig['BCK_PP'], sk=RunConfig['BCK_SK'])
-    bkout.close()
+        nuc, zoom, bsizes = '1H', RunConfig['BCK_1H_LIMITS'], aslist(RunConfig['BCK_1H_1D'])
+    fmt = RunConfig['BCK_FORMAT']
+    if len(bsizes) == 1 or nuc in RunConfig['BCK_REFERENCE']:     # adaptive buckets are computed one size at a time
+        for bsize in bsizes:
+            bkout = open_bucketlist(name, '_%s'%(bsize,) if len(bsizes) > 1 else '')
+            d.bucket1d(file=bkout, zoom=zoom, bsize=bsize, pp=RunConfig['BCK_PP'], sk=RunConfig['BCK_SK'], format=fmt,
+                    mapdir=bucketmap_dir(name), bmap=reference_map(name, nuc, zoom, bsize))
+            bkout.close()
+    else:       # a bucket size sweep, all computed in one pass
+        bkouts = [open_bucketlist(name, '_%s'%(bsize,)) for bsize in bsizes]
+        d.bucket1d_multi(files=bkouts, zoom=zoom, bsizes=bsizes, pp=RunConfig['BCK_PP'], sk=RunConfig['BCK_SK'], format=fmt,
+                    mapdir=bucketmap_dir(name))
+        for bkout in bkouts:
+            bkout.close()
     return d
 
 def plot_1D(d, exp, resdir):
@@ -498,9 +591,34 @@ def plot_1D(d, exp, resdir):
 	    plt.savefig( op.join(resdir, '1D', fidname+'_pp.png'), dpi=300 ) # and a PNG
     plt.close()
 
+def fft_threads(njobs):
+    "returns the number of threads for each FFT, when njobs experiments are processed at the same time"
+    if RunConfig['FFT_THREADS'] > 0:
+        return RunConfig['FFT_THREADS']
+    return max(1, RunConfig['NPROC']//max(1, njobs))
+
+def using_fft(threads):
+    """
+    context manager selecting the FFT backend from RunConfig, for sane and all the NPKData processing, with threads threads per FFT
+    the previous setting is restored on exit, so a pool worker does not carry it to its next task
+    """
+    return fftbackend.using(RunConfig['FFT_BACKEND'], threads)
+
+def sane_2D(d):
+    "applies sane denoising along F1 on d, with the parameters from RunConfig"
+    d.sane(rank=RunConfig['SANERANK'], axis=1, mppool=POOL, precision=RunConfig['SANE_PRECISION'],
+            miniSNR=RunConfig['SANE_MINISNR'], skipped=RunConfig['SANE_SKIPPED'],
+            seed=RunConfig['SANE_SEED'], shared_omega=RunConfig['SANE_SHARED_OMEGA'])
+    return d
+
 def process_2D(xarg):
     "Performs all processing of experiment 'numb2' and produces the spectrum with and without peaks"
-    numb2, resdir = xarg
+    numb2, resdir, threads = xarg
+    with using_fft(threads):
+        return _process_2D(numb2, resdir)
+
+def _process_2D(numb2, resdir):
+    "process_2D() core, called with the FFT set"
     fiddir =  op.dirname(numb2)
     basedir, fidname = op.split(fiddir)
     base, manip =  op.split(basedir)
@@ -537,12 +655,12 @@ def process_2D(xarg):
         if 'etgp' in pulprog :
             d.apod_sin(maxi=0.5, axis=2).zf(zf2=2).ft_sim()
             if sanerank != 0:
-                d.sane(rank=sanerank, axis=1)
+                sane_2D(d)
             d.apod_sin(maxi=0.5, axis=1).zf(zf1=4).bk_ftF1().modulus().rem_ridge()
         else:
             d.apod_sin(maxi=0.5, axis=2).zf(zf2=2).ft_sim()
             if sanerank != 0:
-                d.sane(rank=sanerank, axis=1)
+                sane_2D(d)
             d.apod_sin(maxi=0.5, axis=1).zf(zf1=4).bk_ftF1().modulus().rem_ridge()
         scale = 50.0
         d.axis2.offset += RunConfig['ppm_offset']*d.axis2.frequency
@@ -553,7 +671,7 @@ def process_2D(xarg):
     elif exptype == "COSY":
         d.apod_sin(maxi=0.5, axis=2).zf(zf2=2).ft_sim()
         if sanerank != 0:
-            d.sane(rank=sanerank, axis=1)
+            sane_2D(d)
         d.apod_sin(maxi=0.5, axis=1).zf(zf1=4).bk_ftF1().modulus().rem_ridge()
         scale = 20.0
         d.axis2.offset += RunConfig['ppm_offset']*d.axis2.frequency
@@ -566,7 +684,7 @@ def process_2D(xarg):
         d.apod_sin(maxi=0.5, axis=2).zf(zf2=2).ft_sim()
         if sanerank != 0:
             if d.size1 > 200:   # some HSQC are very short!
-                d.sane(rank=sanerank, axis=1)
+                sane_2D(d)
             else:
                 print('size too small for sane')
         d.apod_sin(maxi=0.5, axis=1).zf(zf1=4).bk_ftF1().modulus().rem_ridge()  # ft_sh()
@@ -581,7 +699,7 @@ def process_2D(xarg):
         if 'et' in pulprog:
             d.conv_n_p()
         if sanerank != 0:
-            d.sane(rank=sanerank, axis=1)
+            sane_2D(d)
         d.apod_sin(maxi=0.5, axis=1).zf(zf1=4).bk_ftF1().modulus().rem_ridge() # For Pharma MB1-X-X series
         scale = 10.0
         d.axis2.offset += RunConfig['ppm_offset']*d.axis2.frequency
@@ -596,8 +714,13 @@ def process_2D(xarg):
     else:
         raise ValueError("Unknown PULPROG in acqus")
 
-    analyze_2D( d, name=op.join(resdir, '2D', exptype+'_'+fidname) )
-    d.save(op.join(fiddir,"processed.gs2"))
+    name = op.join(resdir, '2D', exptype+'_'+fidname)
+    if RunConfig['INPLACE_2D']:     # d is modified by the analysis
+        d.save(op.join(fiddir,"processed.gs2"))
+        analyze_2D( d, name=name, inplace=True )
+    else:
+        analyze_2D( d, name=name )
+        d.save(op.join(fiddir,"processed.gs2"))
     return d, scale
 
 def Dprocess_2D( numb2, resdir ):
@@ -614,7 +737,7 @@ def Dprocess_2D( numb2, resdir ):
     d.unit = 'ppm'
     if 'ste' in exptype or 'led' in exptype:
         print ("DOSY")
-        d = process_DOSY(numb2)
+        d = process_DOSY(numb2, cachedir=palma_cache_dir(resdir))
         scale = 50.0
     else:
         raise Exception("This is not a DOSY: " + numb2)
@@ -644,8 +767,8 @@ def plot_2D(d, scale, numb2, resdir ):
     plt.close()
     return d
 
-def process_DOSY(fid):
-    "Performs all processing of DOSY "
+def process_DOSY(fid, cachedir=None):
+    "Performs all processing of DOSY - PALMA matrices are cached in cachedir if given"
     import spike.plugins.NMR.PALMA as PALMA
     global POOL
     lazy=RunConfig['DOSY_LAZY']
@@ -660,12 +783,13 @@ def process_DOSY(fid):
         dd.axis2.itype = 0
         dd.adapt_size()
     else:
-        d.chsize(sz2=min(16*1024,d.axis2.size))
-        d.apod_em(RunConfig['LB_1H'],axis=2).ft_sim().bruker_corr()
-        # automatic phase correction
-        r = d.row(2)
-        r.apmin()
-        d.phase(r.axis1.P0, r.axis1.P1, axis=2).real()
+        with using_fft(fft_threads(1)):      # the pool is idle during F2 processing
+            d.chsize(sz2=min(16*1024,d.axis2.size))
+            d.apod_em(RunConfig['LB_1H'],axis=2).ft_sim().bruker_corr()
+            # automatic phase correction
+            r = d.row(2)
+            r.apmin()
+            d.phase(r.axis1.P0, r.axis1.P1, axis=2).real()
         # correct
         d.axis2.offset += RunConfig['ppm_offset']*d.axis2.frequency
         # save
@@ -673,9 +797,9 @@ def process_DOSY(fid):
         d.save(op.join(fiddir,"preprocessed.gs2"))
         # ILT
         NN = 256
-        d.prepare_palma(NN, 10.0, 10000.0)
+        d.prepare_palma(NN, 10.0, 10000.0, solver=RunConfig['PALMA_SOLVER'], cachedir=cachedir)
         mppool = POOL
-        dd = d.do_palma(miniSNR=20, nbiter=RunConfig['PALMA_ITER'], lamda=0.05, mppool=mppool )
+        dd = d.do_palma(miniSNR=20, nbiter=RunConfig['PALMA_ITER'], lamda=0.05, mppool=mppool, warm=RunConfig['PALMA_WARM'] )
         if RunConfig['TMS']:
             r = autozero(r)  # calibrate only F2 axis !
             dd.axis2.offset = r.axis1.offset
@@ -683,10 +807,17 @@ def process_DOSY(fid):
     return dd
 
 
-def analyze_2D(d, name, pplevel=10):
-    "Computes peak and bucket lists and exports them as CSV files"
+def analyze_2D(d, name, pplevel=10, inplace=False):
+    """
+    Computes peak and bucket lists and exports them as CSV files
+    smoothing, peak-picking and bucketing all work on a single copy of d,
+    or on d itself if inplace is True - d is then modified
+    """
     from spike.NMR import NMRAxis
-    dd = d.copy() # Removed because of error with 'sane' algorithm
+    if inplace:
+        dd = d
+    else:
+        dd = d.copy() # Removed because of error with 'sane' algorithm
 
     dd.sg2D(window_size=7, order=2) # small smoothing
     noise = findnoiselevel( dd.get_buffer().ravel() )
@@ -704,30 +835,51 @@ def analyze_2D(d, name, pplevel=10):
     pkout = open( name+'_peaklist.csv'  , 'w')
     dd.report_peaks(file=pkout)
     pkout.close() 
-    bkout = open( name+'_bucketlist.csv'  , 'w')
-    BCK_1H_2D = RunConfig['BCK_1H_2D']
-    BCK_13C_2D = RunConfig['BCK_13C_2D']
+    BCK_1H_2D = aslist(RunConfig['BCK_1H_2D'])
+    BCK_13C_2D = aslist(RunConfig['BCK_13C_2D'])
     BCK_1H_LIMITS = RunConfig['BCK_1H_LIMITS']
     BCK_13C_LIMITS = RunConfig['BCK_13C_LIMITS']
-    BCK_DOSY =  RunConfig['BCK_DOSY']
-    BCK_PP = RunConfig['BCK_PP']
+    BCK_DOSY =  aslist(RunConfig['BCK_DOSY'])
     if name.find('COSY') != -1 or name.find('TOCSY') != -1:
-        dd.bucket2d(file=bkout, zoom=(BCK_1H_LIMITS, BCK_1H_LIMITS), bsize=(BCK_1H_2D, BCK_1H_2D), pp=BCK_PP, sk=RunConfig['BCK_SK'] )
+        bucket_2D(dd, name, zoom=(BCK_1H_LIMITS, BCK_1H_LIMITS), bsizes=[(b, b) for b in BCK_1H_2D])
     elif name.find('HSQC') != -1 or name.find('HMBC') != -1:
-        dd.bucket2d(file=bkout, zoom=( BCK_13C_LIMITS, BCK_1H_LIMITS), bsize=(BCK_13C_2D, BCK_1H_2D), pp=BCK_PP, sk=RunConfig['BCK_SK'] )
+        bucket_2D(dd, name, zoom=( BCK_13C_LIMITS, BCK_1H_LIMITS), bsizes=list(itertools.product(BCK_13C_2D, BCK_1H_2D)),
+                    sparse=RunConfig['BCK_SPARSE'], noise=noise )
     elif name.find('DOSY') != -1 :
         ldmin = np.log10(d.axis1.dmin)
         ldmax = np.log10(d.axis1.dmax)
         sw = ldmax-ldmin
         dd.buffer[:,:] = dd.buffer[::-1,:]  # return axis1 
         dd.axis1 = NMRAxis(size=dd.size1, specwidth=100*sw, offset=100*ldmin, frequency = 100.0, itype = 0)     # faking a 100MHz where ppm == log(D)
-        dd.bucket2d(file=bkout, zoom=( (ldmin, ldmax) , BCK_1H_LIMITS), bsize=(BCK_DOSY, BCK_1H_2D), pp=BCK_PP, sk=RunConfig['BCK_SK'] ) #original parameters
+        bucket_2D(dd, name, zoom=( (ldmin, ldmax) , BCK_1H_LIMITS), bsizes=list(itertools.product(BCK_DOSY, BCK_1H_2D)) ) #original parameters
     else:
         print ("*** Name not found!")
-    bkout.close()
     d.peaks = dd.peaks
     return d
 
+def bucket_2D(dd, name, zoom, bsizes, sparse=0, noise=None):
+    """
+    Computes the bucket lists of dd and exports them as CSV files
+    bsizes is a list of (F1,F2) bucket sizes, when there are several, all are computed in one pass
+    and one file per size is produced
+    if sparse > 0, only buckets above sparse*noise are kept, in sparse npz files
+    if a BCK_REFERENCE spectrum is defined for the experiment type, adaptive buckets are used
+    """
+    fmt = 'npz' if sparse > 0 else RunConfig['BCK_FORMAT']
+    exptype = op.basename(name).split('_')[0]
+    if len(bsizes) == 1 or exptype in RunConfig['BCK_REFERENCE']:     # adaptive buckets are computed one size at a time
+        for bsize in bsizes:
+            bkout = open_bucketlist(name, '_%sx%s'%bsize if len(bsizes) > 1 else '', format=fmt)
+            dd.bucket2d(file=bkout, zoom=zoom, bsize=bsize, pp=RunConfig['BCK_PP'], sk=RunConfig['BCK_SK'], format=fmt,
+                    sparse=sparse, noise=noise, mapdir=bucketmap_dir(name), bmap=reference_map(name, exptype, zoom, bsize) )
+            bkout.close()
+    else:
+        bkouts = [open_bucketlist(name, '_%sx%s'%bsize, format=fmt) for bsize in bsizes]
+        dd.bucket2d_multi(files=bkouts, zoom=zoom, bsizes=bsizes, pp=RunConfig['BCK_PP'], sk=RunConfig['BCK_SK'], format=fmt,
+                    sparse=sparse, noise=noise, mapdir=bucketmap_dir(name))
+        for bkout in bkouts:
+            bkout.close()
+
 def process_sample(sample, resdir):
     "Redistributes NMR experiment to corresponding processing"
     global POOL
@@ -764,9 +916,13 @@ def process_sample(sample, resdir):
         else:
             l2D.append(f)
     if l2D != []:
-        xarg = list( zip_longest(l2D, [resdir], fillvalue=resdir) )
+        if POOL is None or len(l2D) == 1:
+            threads = fft_threads(1)
+        else:
+            threads = fft_threads(len(l2D))
+        xarg = [(f, resdir, threads) for f in l2D]
         # print (xarg)
-        if POOL is None:
+        if POOL is None or len(l2D) == 1:    # a single 2D is processed here, and sane() uses the POOL internally
             result2 = imap(process_2D, xarg)
         else:
             result2 = POOL.imap(process_2D, xarg)
@@ -795,15 +951,15 @@ def analysis_report(resdir, fname):
         print("# report from", resdir, file=F)                                 # csv comment
         print("manip, expno, type, file, content", file=F )
         for exp in glob(op.join(resdir,'*')):
-            for f1d in glob(op.join(exp, '1D', '*.csv')):   # all 1D
+            for f1d in glob(op.join(exp, '1D', '*.csv')) + glob(op.join(exp, '1D', '*.npz')):   # all 1D
                 csvname = (op.basename(f1d))
                 csvsplit = csvname.split('_')
-                firstl = open(f1d,'r').readline()
+                firstl = first_line(f1d)
                 print (op.basename(exp), csvsplit[0], '1D', csvname, firstl[1:], sep=',', file=F)
-            for f2d in glob(op.join(exp, '2D', '*.csv')):   # all 1D
+            for f2d in glob(op.join(exp, '2D', '*.csv')) + glob(op.join(exp, '2D', '*.npz')):   # all 1D
                 csvname = (op.basename(f2d))
                 csvsplit = csvname.split('_')
-                firstl = open(f2d,'r').readline()
+                firstl = first_line(f2d)
                 print (op.basename(exp), csvsplit[1], csvsplit[0], csvname, firstl[1:], sep=',', file=F)
 
 #---------------------------------------------------------------------------
@@ -874,6 +1030,8 @@ delete or move to a safe place the folder "Results" located in %s"""%(DIREC))
             continue
         if  op.basename(sp)  == '__pycache__':  # python internal
             continue
+        if  op.basename(sp)  in ('Tensors', 'BucketMaps', 'PalmaCache'):  # produced by a previous run
+            continue
         # ok, go on
         resdir = op.join( DIREC, 'Results', op.basename(sp) )
         mkdir(resdir)
@@ -886,6 +1044,9 @@ delete or move to a safe place the folder "Results" located in %s"""%(DIREC))
             exc_type, exc_value, exc_traceback = sys.exc_info()
             traceback.print_tb(exc_traceback, limit=1, file=sys.stdout)
     analysis_report(op.join( DIREC, 'Results'), op.join( DIREC,'analysis.csv'))
+    if RunConfig['BCK_TENSORS']:
+        import BucketUtilities
+        BucketUtilities.build_tensors(op.join( DIREC, 'Results'), op.join( DIREC, 'Tensors'))
 
 if __name__ == "__main__":
 
@@ -52,63 +52,34 @@ version 1.0
 from __future__ import print_function, division
 import numpy as np
 import numpy.linalg as linalg
-from numpy.fft import fft, ifft
 import unittest
 import time
 from scipy.linalg import norm
 from math import sqrt
 from ..util.signal_tools import findnoiselevel, mfft, mrfft
+from ..util import fftbackend
+from ..util.fftbackend import fft, ifft      # the scipy backend keeps single precision, numpy.fft always computes in double
 
 debug = 0 # put to 1 for debuging message
-###################
-#The following code allows to speed-up fft
-# borrowed from scipy.signals
-def _next_regular(target):
+PRECISIONS = {'double': np.complex128, 'single': np.complex64}    # complex types used for each precision
+def _sane_dtype(precision):
+    "returns the complex type used for computing in precision, either 'double' or 'single'"
+    try:
+        return PRECISIONS[precision]
+    except KeyError:
+        raise Exception("precision should be one of %s"%(", ".join(PRECISIONS.keys())))
+def _get_rng(rng):
     """
-    Find the next regular number greater than or equal to target.
-    Regular numbers are composites of the prime factors 2, 3, and 5.
-    Also known as 5-smooth numbers or Hamming numbers, these are the optimal
-    size for inputs to FFTPACK.
-
-    Target must be a positive integer.
+    returns the random generator to be used from rng
+    None: the global numpy generator, an integer: a new RandomState seeded with it, otherwise rng itself
     """
-    if target <= 6:
-        return target
-    # Quickly check if it's already a power of 2
-    if not (target & (target-1)):
-        return target
-    match = float('inf')  # Anything found will be smaller
-    p5 = 1
-    while p5 < target:
-        p35 = p5
-        while p35 < target:
-            # Ceiling integer division, avoiding conversion to float
-            # (quotient = ceil(target / p35))
-            quotient = -(-target // p35)
-            # Quickly find next power of 2 >= quotient
-            try:
-                p2 = 2**((quotient - 1).bit_length())
-            except AttributeError:
-                # Fallback for Python <2.7
-                p2 = 2**(len(bin(quotient - 1)) - 2)
-            N = p2 * p35
-            if N == target:
-                return N
-            elif N < match:
-                match = N
-            p35 *= 3
-            if p35 == target:
-                return p35
-        if p35 < match:
-            match = p35
-        p5 *= 5
-        if p5 == target:
-            return p5
-    if p5 < match:
-        match = p5
-    return match
-#####################
-def sane(data, k, orda = None, iterations = 1, trick = True, optk = False, ktrick = False):
+    if rng is None:
+        return np.random
+    if isinstance(rng, (int, np.integer)):
+        return np.random.RandomState(rng)
+    return rng
+def sane(data, k, orda = None, iterations = 1, trick = True, optk = False, ktrick = False, precision = 'double', threads = None,
+        rng = None):
     """ 
     sane algorithm. Name stands for Support Selection for Noise Elimination.
     From a data series return a denoised series denoised
@@ -123,6 +94,12 @@ def sane(data, k, orda = None, iterations = 1, trick = True, optk = False, ktric
     ktrick : if a value is given, it permits to change the rank on the second pass.
              The idea is that for the first pass a rank large enough as to be used to compensate for the noise while
              for the second pass a lower rank can be used. 
+    precision : either 'double' (default) or 'single'; in single precision the whole algorithm runs in complex64,
+             which halves the memory traffic, and the result is returned as complex64.
+    threads : the number of threads used by each FFT, default is set by fftbackend.set_backend()
+    rng : the random projections are drawn from the global numpy generator if None,
+             from a generator seeded with rng if it is an integer, so that results are reproducible,
+             or from rng itself if it is a numpy RandomState or Generator.
     
     ########
     values are such that
@@ -155,79 +132,252 @@ def sane(data, k, orda = None, iterations = 1, trick = True, optk = False, ktric
         return data
     #### optimize sizes to next regular
     L = len(data)
-    if L>340:    # last big step is _next_regular(325) == 360; then max extension is 6%
-        Lr = _next_regular(L)
-        orda_r = 2*Lr - _next_regular(2*Lr-orda)
-        if debug>0:
-            if L != Lr or orda != orda_r:
-                print("SANE regularisation %d %d => %d %d"%(L, orda, Lr, orda_r))
-    else:
-        Lr = L
-        orda_r = orda
-    if L != Lr:
-        data_r = np.concatenate((data,np.zeros(Lr-L)))   # create a copy and add zero
+    Lr, orda_r = _regular_sizes(L, orda, k)
+    cdtype = _sane_dtype(precision)
+    rdtype = np.finfo(cdtype).dtype                                     # real type of the same precision
+    if L != Lr or data.dtype != cdtype:
+        data_r = np.zeros(Lr, dtype = cdtype)   # create a copy and add zero
+        data_r[:L] = data
     else:
         data_r = data       # just a link
-    #####
-    if (2*orda_r > data_r.size):                                            # checks if orda not too large.
-        raise(Exception('order is too large'))
-    #####
-    if (k >= orda_r):                                                     # checks if rank not too large
-#        print('type(k) ', type(k))
-        raise(Exception('rank is too large, or orda is too small'))
     N = len(data_r)-orda_r + 1
+    rng = _get_rng(rng)
     dd = data_r.copy()
+    work = None                     # buffer shared by all the Hankel products
     for i in range(iterations+1):
         if i == 1 and ktrick:
-            Omega = np.random.normal(size = (N, ktrick))                            # Omega random real gaussian matrix Nxk
+            Omega = rng.normal(size = (N, ktrick)).astype(rdtype, copy = False)     # Omega random real gaussian matrix Nxk
         else:
-            Omega = np.random.normal(size = (N, k))                            # Omega random real gaussian matrix Nxk
+            Omega = rng.normal(size = (N, k)).astype(rdtype, copy = False)          # Omega random real gaussian matrix Nxk
         if i == 1 and trick:
             dataproj = data_r.copy()          # will project orignal dataset "data.copy()" on denoised basis "dd"
         else:    
             dataproj = dd.copy()            # Makes normal urQRd iterations, for sane_trick, it is the first passage.
+        if work is None or work.shape[1] != Omega.shape[1]:
+            work = np.empty((len(data_r), Omega.shape[1]), dtype = cdtype)
         if trick:
-            Q, QstarH = saneCore(dd, dataproj, Omega)                                # Projection :  H = QQ*H   
-            dd = Fast_Hankel2dt(Q, QstarH)
+            Q, QstarH = saneCore(dd, dataproj, Omega, work, threads)                                # Projection :  H = QQ*H   
+            dd = Fast_Hankel2dt(Q, QstarH, threads)
         elif i != 1 and not trick:  # eliminate from classical urQrd the case i == 1.
-            Q, QstarH = saneCore(dd, dataproj, Omega)                                # Projection :  H = QQ*H   
-            dd = Fast_Hankel2dt(Q, QstarH)
+            Q, QstarH = saneCore(dd, dataproj, Omega, work, threads)                                # Projection :  H = QQ*H   
+            dd = Fast_Hankel2dt(Q, QstarH, threads)
     denoised = dd
     if data.dtype == "float":                                           # this is a kludge, as a complex data-set is to be passed - use the analytic signal if your data are real
         denoised = np.real(denoised)
     return denoised[:L]
 
-def saneCore(dd, data, Omega):
+def _regular_sizes(L, orda, k):
+    """
+    returns (Lr, orda_r) the sizes actually used for a series of length L analysed at order orda
+    L is extended to the next regular number, and orda adapted, for faster FFT
+    checks that the rank k is compatible with these sizes
+    """
+    if L>340:    # last big step is next_regular(325) == 360; then max extension is 6%
+        Lr = fftbackend.next_regular(L)     # 5-smooth sizes, independent of the FFT backend, so results do not depend on it
+        orda_r = 2*Lr - fftbackend.next_regular(2*Lr-orda)
+        if debug>0:
+            if L != Lr or orda != orda_r:
+                print("SANE regularisation %d %d => %d %d"%(L, orda, Lr, orda_r))
+    else:
+        Lr = L
+        orda_r = orda
+    #####
+    if (2*orda_r > Lr):                                            # checks if orda not too large.
+        raise(Exception('order is too large'))
+    #####
+    if (k >= orda_r):                                                     # checks if rank not too large
+        raise(Exception('rank is too large, or orda is too small'))
+    return Lr, orda_r
+
+def sane_batch(block, k, orda = None, iterations = 1, trick = True, ktrick = False, rng = None, precision = 'double', threads = None,
+        shared_omega = False):
+    """
+    batched version of sane()
+    denoises together all the series of block, a (n, L) numpy buffer, one series per row.
+    Random projections, QR decompositions and Hankel products are computed on stacked arrays,
+    so the python overhead is paid once for the n series instead of n times.
+    Use it to process all the columns of a 2D, or the columns of several same-sized experiments.
+    
+    parameters are the same as for sane(), optk is not available here.
+    rng : as for sane(), or a list of n seeds (or generators), one per series,
+             each series then gets the same result as sane() with its own rng, whatever the other series in block.
+    shared_omega : if True, a single random projection matrix Omega is drawn at each pass, and used for all the series,
+             the first Hankel product is then a true matrix-matrix product, with Omega transformed only once.
+             Each series then gets the same result as sane() with the same rng seed.
+    series which are empty are returned unchanged.
+    returns the (n, L) denoised block
+    """
+    block = np.atleast_2d(block)
+    n, L = block.shape
+    if not orda:
+        orda = L//2
+    Lr, orda_r = _regular_sizes(L, orda, max(k, ktrick or 0))
+    cdtype = _sane_dtype(precision)
+    rdtype = np.finfo(cdtype).dtype
+    result = block.astype(cdtype)                           # a copy
+    full = np.abs(block).max(axis=1) > 1E-8                 # as np.allclose(data, 0.0) in sane()
+    m = np.count_nonzero(full)
+    if m == 0:
+        return block.copy()
+    data_r = np.zeros((m, Lr), dtype=cdtype)
+    data_r[:, :L] = block[full]
+    N = Lr-orda_r + 1
+    if np.ndim(rng) == 1:                                   # one generator per series
+        if shared_omega:
+            raise Exception("shared_omega needs a single rng")
+        if len(rng) != n:
+            raise Exception("rng should hold one seed per series")
+        rngs = [_get_rng(r) for (r, f) in zip(rng, full) if f]
+        draw = lambda kk: np.array([r.normal(size = (N, kk)) for r in rngs])
+    else:
+        rng = _get_rng(rng)
+        size = (N,) if shared_omega else (m, N)
+        draw = lambda kk: rng.normal(size = size+(kk,))
+    dd = data_r.copy()
+    work = None
+    for i in range(iterations+1):                           # same sequence as in sane()
+        if i == 1 and ktrick:
+            Omega = draw(ktrick).astype(rdtype, copy = False)
+        else:
+            Omega = draw(k).astype(rdtype, copy = False)
+        if i == 1 and trick:
+            dataproj = data_r
+        else:
+            dataproj = dd
+        if work is None or work.shape[2] != Omega.shape[-1]:
+            work = np.empty((m, Lr, Omega.shape[-1]), dtype = cdtype)
+        if trick or i != 1:
+            Q, QstarH = saneCore_batch(dd, dataproj, Omega, work, threads)
+            dd = Fast_Hankel2dt_batch(Q, QstarH, threads)
+    result[full] = dd[:, :L]
+    if block.dtype == "float":
+        return np.real(result)
+    return result
+
+def _sane_chunk(task):
+    """
+    denoises in place with sane_batch() the series start:stop of a stack - possibly in another process
+    the stack is either a numpy array, or the name of the shared memory block holding it
+    used by the sane plugin to distribute the work over a pool - it lives here so that it can be pickled
+    """
+    source, shape, start, stop, seeds, rank, kw = task      # seeds: one per series, or a single one if shared_omega
+    if isinstance(source, str):
+        from ..util.sharedmem import attach
+        shm = attach(source)        # owned by the calling process, which unlinks it
+        stack = np.ndarray(shape, dtype=complex, buffer=shm.buf)
+        stack[start:stop] = sane_batch(stack[start:stop], rank, rng=seeds, **kw)
+        del stack           # the buffer should be released before closing
+        shm.close()
+    else:
+        source[start:stop] = sane_batch(source[start:stop], rank, rng=seeds, **kw)
+    return (start, stop)
+
+def saneCore_batch(dd, data, Omega, work = None, threads = None):
+    """
+    Core of sane algorithm, on stacked series
+    dd, data are (n, L), Omega is (n, N, k), or (N, k) if shared by all series
+    work : an optional (n, L, k) complex buffer for the Hankel products
+    """
+    Y = FastHankel_prod_batch(dd, Omega, work, threads)
+    Q, r = linalg.qr(Y)                                                  # stacked QR decompositions
+    del(r)
+    QstarH = FastHankel_prod_batch(data.conj(), Q, work, threads).conj().transpose(0, 2, 1)
+    return Q, QstarH
+
+def FastHankel_prod_batch(gene_vect, matrix, work = None, threads = None):
+    """
+    stacked version of FastHankel_prod_mat_mat
+    gene_vect is (n, L), matrix is (n, N, K)
+    or (N, K), the same matrix being then used for all the n Hankel matrices, and transformed only once
+    work : an optional (n, L, K) complex buffer, reused from call to call
+    returns the (n, M, K) products of the n Hankel matrices by the n matrices, with M = L-N+1
+    """
+    n, L = gene_vect.shape
+    N, K = matrix.shape[-2:]
+    M = L-N+1
+    dtype = np.result_type(gene_vect, matrix, np.complex64)             # complex64 only if all are single precision
+    if matrix.ndim == 2:
+        probe = np.zeros((L, K), dtype = dtype)
+        probe[M-1:] = matrix[::-1]
+        prod = fft(gene_vect, axis=1, threads=threads)[:, :, None] * fft(probe, axis=0, threads=threads)
+    else:
+        if work is None or work.shape != (n, L, K) or work.dtype != dtype:
+            work = np.empty((n, L, K), dtype = dtype)
+        work[:, :M-1] = 0.0
+        work[:, M-1:] = matrix[:, ::-1, :]                              # probes are completed with zero to length L
+        prod = fft(work, axis=1, threads=threads)
+        prod *= fft(gene_vect, axis=1, threads=threads)[:, :, None]
+    c = ifft(prod, axis=1, threads=threads)
+    data = np.empty((n, M, K), dtype = dtype)
+    data[:, 0] = c[:, -1]                                               # same as np.roll(c, +1)[:M]
+    data[:, 1:] = c[:, :M-1]
+    return data
+
+def Fast_Hankel2dt_batch(Q, QH, threads = None):
+    """
+    stacked version of Fast_Hankel2dt
+    Q is (n, M, K), QH is (n, K, N)
+    the sum on the antidiagonals of Q.QH is the sum over K of the convolutions of Q[:,k] by QH[k,:]
+    which is computed in the Fourier space, with a single inverse transform.
+    returns the (n, L) denoised series, with L = M+N-1
+    """
+    n, M, K = Q.shape
+    N = QH.shape[2]
+    L = M+N-1
+    prod = fft(Q, n=L, axis=1, threads=threads)
+    prod *= fft(QH, n=L, axis=2, threads=threads).transpose(0, 2, 1)
+    vec_sum = ifft(prod.sum(axis=2), axis=1, threads=threads)
+    vec_sum *= vec_mean(M, L)                                           # in place, keeps the precision
+    return vec_sum
+
+def saneCore(dd, data, Omega, work = None, threads = None):
     '''
     Core of sane algorithm
+    work : an optional (L, k) complex buffer for the Hankel products
     '''
-    Y =  FastHankel_prod_mat_mat(dd, Omega)
+    Y =  FastHankel_prod_mat_mat(dd, Omega, work, threads)
     Q, r = linalg.qr(Y)                                                  # QR decompsition of Y
     del(r)                                                              # we don't need it any more
-    QstarH = FastHankel_prod_mat_mat(data.conj(), Q).conj().T# 
+    QstarH = FastHankel_prod_mat_mat(data.conj(), Q, work, threads).conj().T# 
     return Q, QstarH                                                    # H approximation given by QQ*H    
 
+_VEC_MEAN = {}      # vec_mean() cache, indexed by (M, L)
 def vec_mean(M, L):
     '''
     Vector for calculating the mean from the sum on the antidiagonal.
     data = vec_sum*vec_mean
+    vectors are cached, and returned read-only
     '''
-    vec_prod_diag = [1/float((i+1)) for i in range(M)]
-    vec_prod_middle = [1/float(M) for i in range(L-2*M)]
-    vec_mean_prod_tot = vec_prod_diag + vec_prod_middle + vec_prod_diag[::-1]
-    return np.array(vec_mean_prod_tot)
-
-def FastHankel_prod_mat_mat(gene_vect, matrix):
+    try:
+        return _VEC_MEAN[(M, L)]
+    except KeyError:
+        pass
+    vec_prod_diag = 1.0/np.arange(1, M+1)
+    vec_mean_prod_tot = np.concatenate((vec_prod_diag, np.full(L-2*M, 1.0/M), vec_prod_diag[::-1]))
+    vec_mean_prod_tot.flags.writeable = False
+    _VEC_MEAN[(M, L)] = vec_mean_prod_tot
+    return vec_mean_prod_tot
+
+def FastHankel_prod_mat_mat(gene_vect, matrix, work = None, threads = None):
     '''
-    Fast Hankel structured matrix matrix product based on FastHankel_prod_mat_vec
+    Fast Hankel structured matrix matrix product, same as FastHankel_prod_mat_vec on each column of matrix
+    the generator vector is Fourier transformed once, and the K columns of matrix in a single FFT along axis 0.
+    work : an optional (L, K) complex buffer, reused from call to call to hold the zero-completed columns
     '''
     N,K = matrix.shape 
     L = len(gene_vect)
     M = L-N+1
-    data = np.zeros(shape = (M, K), dtype = complex)
-    for k in range(K):
-        prod_vect = matrix[:, k] 
-        data[:,k] = FastHankel_prod_mat_vec(gene_vect, prod_vect) 
+    dtype = np.result_type(gene_vect, matrix, np.complex64)             # complex64 only if all are single precision
+    if work is None or work.shape != (L, K) or work.dtype != dtype:
+        work = np.empty((L, K), dtype = dtype)
+    work[:M-1] = 0.0
+    work[M-1:] = matrix[::-1]                                           # columns completed with zero to length L
+    prod = fft(work, axis = 0, threads = threads)
+    prod *= fft(gene_vect, threads = threads)[:, None]                  # generator transformed only once
+    c = ifft(prod, axis = 0, threads = threads)
+    data = np.empty((M, K), dtype = dtype)
+    data[0] = c[-1]                                                     # same as np.roll(c, +1)[:M]
+    data[1:] = c[:M-1]
     return data
 
 def FastHankel_prod_mat_vec(gene_vect, prod_vect):
@@ -245,22 +395,21 @@ def FastHankel_prod_mat_vec(gene_vect, prod_vect):
     c = ifft(prod)                                                      # IFFT for going back 
     return np.roll(c, +1)[:M]
 
-def Fast_Hankel2dt(Q,QH):
+def Fast_Hankel2dt(Q, QH, threads = None):
     '''
     returning to data from Q and QstarH
-    Based on FastHankel_prod_mat_vec.
+    the sum on the antidiagonals of Q.QH is the sum over K of the convolutions of Q[:,k] by QH[k,:]
+    all K are transformed in one FFT pair, and summed over the rank in the Fourier space,
+    so a single inverse transform is needed.
     '''
     M,K = Q.shape 
     K,N = QH.shape 
     L = M+N-1
-    vec_sum = np.zeros((L,), dtype = complex)
-    for k in range(K):
-        prod_vect = QH[k,:]
-        gene_vect = np.concatenate((np.zeros(N-1), Q[:, k], np.zeros(N-1))) # generator vector for Toeplitz matrix
-        vec_k = FastHankel_prod_mat_vec(gene_vect, prod_vect[::-1])         # used as fast Toeplitz
-        vec_sum += vec_k 
-    datadenoised = vec_sum*vec_mean(M, L)                                    # from the sum on the antidiagonal to the mean
-    return datadenoised
+    prod = fft(Q, n = L, axis = 0, threads = threads)                   # zero-completed to L, so the convolution is linear
+    prod *= fft(QH, n = L, axis = 1, threads = threads).T
+    vec_sum = ifft(prod.sum(axis = 1), threads = threads)
+    vec_sum *= vec_mean(M, L)                                           # from the sum on the antidiagonal to the mean, in place to keep precision
+    return vec_sum
 
 
 
@@ -551,6 +700,29 @@ def test_sane(
     plt.legend()
     plt.show()
 
+def bench_FastHankel(sizes = (256, 512, 1024, 2048, 4096), k = 20, repeat = 10):
+    """
+    micro-benchmark of the Hankel product engine
+    compares FastHankel_prod_mat_mat to a loop of FastHankel_prod_mat_vec over the k columns
+    for series of length L in sizes, with orda = L/2
+    """
+    print("%6s %12s %12s %8s"%("L", "loop (ms)", "mat_mat (ms)", "gain"))
+    for L in sizes:
+        gene = np.random.randn(L) + 1j*np.random.randn(L)
+        N = L - L//2 + 1
+        Omega = np.random.normal(size = (N, k))
+        work = np.empty((L, k), dtype = complex)
+        t0 = time.time()
+        for r in range(repeat):
+            ref = np.array([FastHankel_prod_mat_vec(gene, Omega[:, j]) for j in range(k)]).T
+        tloop = (time.time()-t0)/repeat
+        t0 = time.time()
+        for r in range(repeat):
+            res = FastHankel_prod_mat_mat(gene, Omega, work)
+        tmat = (time.time()-t0)/repeat
+        assert np.allclose(ref, res)
+        print("%6d %12.3f %12.3f %8.1f"%(L, 1000*tloop, 1000*tmat, tloop/tmat))
+
 class sane_Tests(unittest.TestCase):
     def test_sane(self):
         '''
@@ -579,6 +751,159 @@ class sane_Tests(unittest.TestCase):
                             nb_iterat = it, 
                             trick = True )
                             
+    def test_FastHankel(self):
+        """
+        FastHankel_prod_mat_mat is equivalent to FastHankel_prod_mat_vec on each column
+        """
+        for (L, N) in ((100, 51), (101, 40), (360, 181)):
+            gene = np.random.randn(L) + 1j*np.random.randn(L)
+            matrix = np.random.normal(size = (N, 7))
+            ref = np.array([FastHankel_prod_mat_vec(gene, matrix[:, j]) for j in range(7)]).T
+            work = np.empty((L, 7), dtype = complex)
+            self.assertTrue(np.allclose(FastHankel_prod_mat_mat(gene, matrix, work), ref))
+            self.assertTrue(np.allclose(FastHankel_prod_mat_mat(gene, matrix), ref))
+
+    def test_Hankel2dt(self):
+        """
+        Fast_Hankel2dt is the mean over the antidiagonals of Q.QH
+        """
+        M, N, K = 30, 45, 4
+        Q = np.random.randn(M, K) + 1j*np.random.randn(M, K)
+        QH = np.random.randn(K, N) + 1j*np.random.randn(K, N)
+        H = np.dot(Q, QH)[::-1]                     # antidiagonals of H are the diagonals of H[::-1]
+        ref = np.array([H.diagonal(i).mean() for i in range(-M+1, N)])
+        self.assertTrue(np.allclose(Fast_Hankel2dt(Q, QH), ref))
+        self.assertTrue(vec_mean(M, M+N-1) is vec_mean(M, M+N-1))
+
+    def test_regular_sizes(self):
+        """
+        series are extended to 5-smooth sizes, whatever the FFT backend
+        """
+        for L, Lr in ((300, 300), (341, 360), (1025, 1080), (4097, 4320)):
+            self.assertEqual(_regular_sizes(L, L//3, 5)[0], Lr)
+    def test_sane_batch(self):
+        """
+        sane_batch() on stacked series is equivalent to sane() on each of them
+        """
+        n, L = 5, 400
+        x = np.arange(L)/float(L)
+        block = np.zeros((n, L), dtype=complex)
+        for i in range(n):
+            block[i] = (i+1)*np.exp(2j*np.pi*(40+13*i)*x - 3*x) + 0.3*(np.random.randn(L) + 1j*np.random.randn(L))
+        block[2] = 0.0                          # an empty series is left untouched
+        # Hankel products against the sequential versions
+        Omega = np.random.normal(size=(n, 201, 8))
+        Y = FastHankel_prod_batch(block, Omega)
+        for i in range(n):
+            self.assertTrue(np.allclose(Y[i], FastHankel_prod_mat_mat(block[i], Omega[i])))
+        Q = np.linalg.qr(Y)[0]
+        QHr = np.random.normal(size=(n, 8, 201)) + 1j*np.random.normal(size=(n, 8, 201))
+        D = Fast_Hankel2dt_batch(Q, QHr)
+        for i in range(n):
+            self.assertTrue(np.allclose(D[i], Fast_Hankel2dt(Q[i], QHr[i])))
+        # full algorithm, with the same random draws, series one by one
+        for i in range(n):
+            np.random.seed(123)
+            ref = sane(block[i], 6, orda=150, iterations=2)
+            np.random.seed(123)
+            res = sane_batch(block[i:i+1], 6, orda=150, iterations=2)
+            self.assertTrue(np.allclose(res[0], ref))
+        res = sane_batch(block, 6, orda=150)
+        self.assertEqual(res.shape, block.shape)
+        self.assertTrue(np.all(res[2] == 0.0))
+        # shared Omega, seeded
+        res = sane_batch(block, 6, orda=150, iterations=2, rng=17, shared_omega=True)
+        for i in (0, 1, 3, 4):
+            self.assertTrue(np.allclose(res[i], sane(block[i], 6, orda=150, iterations=2, rng=17)))
+        self.assertTrue(np.array_equal(res, sane_batch(block, 6, orda=150, iterations=2, rng=17, shared_omega=True)))
+
+    def test_sane_single(self):
+        """
+        single precision gives the same buckets as double precision
+        """
+        n, L = 8, 512
+        x = np.arange(L)/float(L)
+        block = np.zeros((n, L), dtype=complex)
+        for i in range(n):
+            for f in (30, 95+i, 170):
+                block[i] += 10*np.exp(2j*np.pi*f*x - 4*x)
+            block[i] += np.random.randn(L) + 1j*np.random.randn(L)
+        res = {}
+        for precision in ('double', 'single'):
+            rng = np.random.RandomState(12)
+            res[precision] = sane_batch(block, 8, iterations=1, rng=rng, precision=precision)
+        self.assertEqual(res['single'].dtype, np.complex64)
+        self.assertEqual(res['double'].dtype, np.complex128)
+        buckets = {}
+        for precision in res:
+            spec = abs(np.fft.fft(res[precision].astype(complex), axis=1))
+            buckets[precision] = spec.reshape(n, L//16, 16).sum(axis=2)         # 16 points buckets
+        err = abs(buckets['single']-buckets['double']).max()/buckets['double'].max()
+        self.assertTrue(err < 1E-4)
+        np.random.seed(3)
+        r1 = sane(block[0], 8, precision='single')
+        self.assertEqual(r1.dtype, np.complex64)
+        self.assertRaises(Exception, sane, block[0], 8, precision='half')
+
+    def _series_data(self, n=12, L=400):
+        "a 2D NMRData holding n complex series of length L along F2, and the (n, L) block of these series"
+        from spike.NMR import NMRData
+        from spike.plugins.sane import _set_series_block
+        rs = np.random.RandomState(21)
+        x = np.arange(L)/float(L)
+        block = 0.3*(rs.randn(n, L) + 1j*rs.randn(n, L))
+        for i in range(n):
+            block[i] += (i+1)*np.exp(2j*np.pi*(40+7*i)*x - 3*x)
+        d = NMRData(buffer=np.zeros((n, 2*L)))
+        d.axis2.itype = 1
+        _set_series_block(d, 2, block)
+        return d, block
+
+    def test_sane_series(self):
+        """
+        sane_series() gives the same result serially, over a process pool and over threads,
+        and each series is denoised as sane() would do it
+        """
+        import multiprocessing as mp
+        from spike.plugins.sane import sane_series, _series_block
+        d, block = self._series_data()
+        ref = sane_series([d.copy()], 6, orda=150, axis=2, batch=4, seed=5)[0]
+        pool = mp.Pool(2)
+        try:
+            res = sane_series([d.copy()], 6, orda=150, axis=2, batch=4, seed=5, mppool=pool)[0]
+        finally:
+            pool.close()
+            pool.join()
+        self.assertTrue(np.array_equal(res.buffer, ref.buffer))
+        res = sane_series([d.copy()], 6, orda=150, axis=2, batch=4, seed=5, workers=3)[0]
+        self.assertTrue(np.array_equal(res.buffer, ref.buffer))
+        # the ith series is seeded with seed+i
+        res = _series_block(ref, 2)
+        for i in range(block.shape[0]):
+            self.assertTrue(np.allclose(res[i], sane(block[i], 6, orda=150, rng=5+i)))
+
+    def test_sane_seed(self):
+        """
+        seed makes sane_series() and the sane plugin reproducible, whatever batch,
+        and shared_omega uses the projections of sane(rng=seed) for all series
+        """
+        from spike.plugins.sane import sane_series, _series_block
+        d, block = self._series_data()
+        np.random.seed(1)
+        r1 = sane_series([d.copy()], 6, orda=150, axis=2, batch=4, seed=5)[0]
+        np.random.seed(2)                       # the global generator does not matter
+        r2 = sane_series([d.copy()], 6, orda=150, axis=2, batch=4, seed=5)[0]
+        self.assertTrue(np.array_equal(r1.buffer, r2.buffer))
+        r3 = sane_series([d.copy()], 6, orda=150, axis=2, batch=4, seed=6)[0]
+        self.assertFalse(np.array_equal(r1.buffer, r3.buffer))
+        for batch in (0, 1, 5, 128):            # independent of batch, one by one (0) included
+            res = d.copy().sane(rank=6, orda=150, axis=2, batch=batch, seed=5)
+            self.assertTrue(np.allclose(res.buffer, r1.buffer))
+        for batch in (4, 5):                    # independent of the chunking
+            res = _series_block(sane_series([d.copy()], 6, orda=150, axis=2, batch=batch, seed=5, shared_omega=True)[0], 2)
+            for i in range(block.shape[0]):
+                self.assertTrue(np.allclose(res[i], sane(block[i], 6, orda=150, rng=5)))
+
     def _test_optim(self):
         '''
         Test of the rank optimization.
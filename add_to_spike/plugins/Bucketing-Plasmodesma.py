@@ -8,20 +8,600 @@ Created by DELSUC Marc-André on 2015-09-06.
 """
 
 from __future__ import print_function
+import os
+import os.path as op
+import sys
+import hashlib
 import numpy as np
+import scipy.stats as stats
 import unittest
 
 from spike import NPKError
 from spike.NPKData import NPKData_plugin, NPKData
+from spike.util.signal_tools import findnoiselevel
 
 #---------------------------------------------------------------------------
-def bucket1d(data, zoom=(0.5, 9.5), bsize=0.04, file=None):
+# vectorized engine
+# buckets are computed from boundaries built once, and merged from cell tables:
+# the sum, max, min, peak count and centred moments of the cells between consecutive bucket limits,
+# reduced with ufunc.reduceat() in a single scan of a view of the spectrum
+def _real_view(data):
+    """
+    returns the real part of data as a read-only strided view of its buffer - no copy is made -
+    along with the corresponding axes, as they would be after data.real()
+    """
+    sl, axes = [], []
+    for i in range(1, data.dim+1):
+        ax = data.axes(i).copy()
+        if ax.itype == 1:       # complex are stored interleaved
+            sl.append(slice(None, None, 2))
+            ax.itype = 0
+        else:
+            sl.append(slice(None))
+        axes.append(ax)
+    buf = data.buffer[tuple(sl)]
+    buf.setflags(write=False)
+    for ax, n in zip(axes, buf.shape):
+        ax.size = n             # as in data.adapt_size()
+    return buf, axes
+
+def _bucket_edges(start, end, bsize):
+    """
+    returns the ppm values of the bucket starting edges, and the bucket centers
+    the running sum is the one used by the loop engine, so that values are bit-identical
+    """
+    here = min(start, end)
+    there = max(start, end)
+    n = int(np.ceil((there-here)/bsize)) + 2
+    edges = np.cumsum(np.r_[here-bsize/2, np.full(n, bsize)])    # sequential sum, as in the loop
+    centers = np.cumsum(np.r_[here, np.full(n, bsize)])
+    nb = np.count_nonzero(edges < there)
+    return edges[:nb+1], centers[:nb]
+
+class BucketMap(object):
+    """
+    the bucket boundaries along one axis, for a given axis calibration, zoom window and bucket size
+    - edges, centers : the ppm values of the bucket edges and centers
+    - pos : the (non rounded) point positions of the edges on the reference axis
+    - widths : the bucket widths in ppm, bsize for regular buckets, an array for adaptive ones
+    a map is built once and reused for all spectra sharing the same calibration, see bucket_map()
+    an axis with a different offset (as set by autozero) is handled by shifting the reference positions
+    edges and centers may be given, as done by adaptive_buckets(), otherwise regular buckets are built
+    """
+    def __init__(self, axis, start, end, bsize, edges=None, centers=None):
+        self.key = BucketMap.key_of(axis, start, end, bsize)
+        self.offset = float(axis.offset)
+        if edges is None:
+            edges, centers = _bucket_edges(start, end, bsize)
+            self.widths = bsize
+        else:
+            self.widths = np.diff(edges)
+        self.edges, self.centers = edges, centers
+        self.pos = axis.ptoi(edges)
+        self._index = None
+    @staticmethod
+    def key_of(axis, start, end, bsize):
+        "the calibration key of a map - the offset is not part of it, as it is handled by shifting"
+        return (int(axis.size), float(axis.specwidth), float(axis.frequency), float(start), float(end), float(bsize))
+    def check(self, axis):
+        "raises NPKError if axis does not have the calibration of the map"
+        if BucketMap.key_of(axis, *self.key[3:]) != self.key:
+            raise NPKError("the bucket map was built for another axis calibration")
+    def sizes(self, ind):
+        "the widths of the buckets in ind, as returned by index() - a scalar for regular buckets"
+        if np.ndim(self.widths) == 0:
+            return self.widths
+        return self.widths[:len(ind[0])]
+    def index(self, axis):
+        """
+        returns (centers, ih, inext) for axis, where bucket k spans the points [inext[k]:ih[k]]
+        axis should have the calibration of the map, except for the offset
+        """
+        if float(axis.offset) == self.offset:
+            if self._index is None:
+                self._index = self._bounds(self.pos)
+            return self._index
+        # ptoi() is linear in offset
+        shift = (axis.size-1)*(axis.offset-self.offset)/axis.specwidth
+        return self._bounds(self.pos + shift)
+    def _bounds(self, pos):
+        "rounds the edge positions into bucket limits"
+        idx = np.round(pos).astype(int)
+        centers, ih, inext = self.centers, idx[:-1], idx[1:]
+        neg = np.nonzero((ih<0) | (inext<0))[0]      # the loop stops on the first negative index
+        if len(neg) > 0:
+            nb = neg[0]
+            centers, ih, inext = centers[:nb], ih[:nb], inext[:nb]
+        return centers, ih, inext
+    @staticmethod
+    def filename(mapdir, key):
+        "the file in which the map with key is stored in mapdir"
+        return op.join(mapdir, "bucketmap_%s.npz"%hashlib.sha1(repr(key).encode()).hexdigest()[:16])
+    def save(self, mapdir):
+        "stores the map in mapdir - written to a temporary file first, as several processes may share mapdir"
+        if not op.isdir(mapdir):
+            os.makedirs(mapdir, exist_ok=True)
+        fname = BucketMap.filename(mapdir, self.key)
+        tmp = "%s.%d.tmp"%(fname, os.getpid())
+        with open(tmp, 'wb') as F:
+            np.savez(F, key=np.array(self.key), offset=self.offset, edges=self.edges, centers=self.centers, pos=self.pos,
+                    widths=self.widths)
+        os.replace(tmp, fname)
+    @classmethod
+    def load(cls, fname):
+        "loads a map stored with save()"
+        bmap = cls.__new__(cls)
+        with np.load(fname) as F:
+            key = F['key']
+            bmap.key = (int(key[0]),) + tuple(float(k) for k in key[1:])
+            bmap.offset = float(F['offset'])
+            bmap.edges, bmap.centers, bmap.pos = F['edges'], F['centers'], F['pos']
+            bmap.widths = F['widths'] if F['widths'].ndim > 0 else float(F['widths'])
+        bmap._index = None
+        return bmap
+
+_BUCKETMAPS = {}    # in-process cache of the BucketMap, keyed by BucketMap.key_of()
+def bucket_map(axis, start, end, bsize, mapdir=None):
+    """
+    returns the BucketMap for axis, zoom (start, end) and bsize
+    maps are cached in memory, and if mapdir is given, on disk in mapdir as well
+    """
+    key = BucketMap.key_of(axis, start, end, bsize)
+    bmap = _BUCKETMAPS.get(key)
+    if bmap is None and mapdir is not None:
+        fname = BucketMap.filename(mapdir, key)
+        if op.exists(fname):
+            bmap = BucketMap.load(fname)
+    if bmap is None:
+        bmap = BucketMap(axis, start, end, bsize)
+        if mapdir is not None:
+            bmap.save(mapdir)
+    _BUCKETMAPS[key] = bmap
+    return bmap
+
+def _bucket_index(axis, start, end, bsize, mapdir=None):
+    """
+    computes all the bucket boundaries along axis in one call, using the cached BucketMap
+    returns (centers, ih, inext) where bucket k spans the points [inext[k]:ih[k]]
+    """
+    return bucket_map(axis, start, end, bsize, mapdir).index(axis)
+
+def _minima_edges(ref, pos, halfwidth):
+    """
+    moves each edge position pos (in points) to the deepest local minimum of ref found within +/- halfwidth points
+    edges with no local minimum in their window are left unchanged
+    all edges are processed at once, on a (nedges, 2*halfwidth+1) window array
+    """
+    n = len(ref)
+    core = ref[1:-1]
+    val = np.full(n, np.inf)
+    val[1:-1] = np.where((core <= ref[:-2]) & (core <= ref[2:]), core, np.inf)
+    idx = np.round(pos).astype(int)[:, None] + np.arange(-halfwidth, halfwidth+1)[None, :]
+    vals = np.where((idx >= 0) & (idx < n), val[np.clip(idx, 0, n-1)], np.inf)
+    best = np.argmin(vals, axis=1)
+    rows = np.arange(len(pos))
+    return np.where(np.isfinite(vals[rows, best]), idx[rows, best], pos)
+
+def _adaptive_map(ref, axis, start, end, bsize, window):
+    """
+    builds a BucketMap along axis with edges at the minima of ref, a real 1D buffer
+    the inner edges of the regular buckets are moved within +/- window*bsize, the outer ones are kept
+    """
+    if not 0 < window < 0.5:
+        raise NPKError("window should be within ]0, 0.5[")
+    edges, centers = _bucket_edges(start, end, bsize)
+    pos = axis.ptoi(edges)
+    halfwidth = int(window*bsize*(axis.size-1)*axis.frequency/axis.specwidth)     # in points
+    moved = _minima_edges(ref, pos[1:-1], halfwidth)
+    edges = np.r_[edges[0], np.where(moved == pos[1:-1], edges[1:-1], axis.itop(moved)), edges[-1]]
+    centers = (edges[:-1] + edges[1:])/2
+    return BucketMap(axis, start, end, bsize, edges=edges, centers=centers)
+
+def _map_index(axis, start, end, bsize, bmap, mapdir):
+    """
+    the (centers, ih, inext) bucket limits along axis and the bucket widths,
+    either from bmap if given, or from the cached regular buckets
+    """
+    if bmap is None:
+        return _bucket_index(axis, start, end, bsize, mapdir), bsize
+    bmap.check(axis)
+    ind = bmap.index(axis)
+    return ind, bmap.sizes(ind)
+
+def _clipped(ind, n):
+    "returns the (lo, hi) point limits of the buckets in ind, as obtained when slicing a buffer of size n"
+    centers, ih, inext = ind
+    return np.clip(inext, 0, n), np.clip(ih, 0, n)
+
+def _cell_limits(lims):
+    """
+    the cell limits along one axis: the sorted union of the limits of the buckets in lims, a list of (lo, hi)
+    each bucket of lims is then a run of contiguous cells
+    """
+    return np.unique(np.concatenate([np.r_[lo, hi] for (lo, hi) in lims]))
+
+_STRIP = 1<<18      # the number of points processed at once by _peak_mask() and _bucket_tables()
+
+def _peak_mask(buf, threshold):
+    """
+    the local maxima of buf above threshold, as detected by the spike peak-pickers pp()
+    1D: larger than both neighbours,  2D: larger than the 4 nearest neighbours
+    """
+    mask = np.zeros(buf.shape, dtype=bool)
+    buf = buf[(slice(-1),)*buf.ndim]      # pp() scans the axes borders, which exclude the last point
+    if buf.ndim == 1:
+        tbuff = buf[1:-1]
+        mask[1:-2] = (tbuff > threshold) & (tbuff > buf[:-2]) & (tbuff > buf[2:])
+    else:       # by strips of rows, to keep the temporaries small
+        n1, n2 = buf.shape
+        step = max(1, _STRIP//n2)
+        for i in range(1, n1-1, step):
+            j = min(i+step, n1-1)
+            tbuff = buf[i:j, 1:-1]
+            m = (tbuff > threshold)
+            m &= (tbuff > buf[i-1:j-1, 1:-1])
+            m &= (tbuff > buf[i+1:j+1, 1:-1])
+            m &= (tbuff > buf[i:j, :-2])
+            m &= (tbuff > buf[i:j, 2:])
+            mask[i:j, 1:n2-1] = m
+    return mask
+
+def _noiselevel(buf, nbseg=20, flat=False):
+    """
+    the value of findnoiselevel(buf), computed segment by segment, as findnoiselevel() copies buf
+    flat gives the value of findnoiselevel(buf.ravel()) for a 2D buf, copying at most one segment
+    when buf is a strided view
+    """
+    size = buf.size if flat else len(buf)
+    less = size%nbseg
+    n = (size-less)//nbseg
+    def segment(first, last):
+        "the points [first:last] of buf, or of the flattened buf"
+        if not flat or buf.ndim == 1:
+            return buf[first:last]
+        n2 = buf.shape[1]
+        r0 = first//n2
+        return buf[r0:(last-1)//n2+1].ravel()[first-r0*n2:last-r0*n2]
+    levels = np.array([segment(less+k*n, less+(k+1)*n).std(axis=0) for k in range(nbseg)])
+    levels.sort()
+    if nbseg < 4:
+        return levels[0]
+    return np.mean(levels[0:nbseg//4])
+
+def _bucket_tables(buf, lims, peaks=None, sk=False):
+    """
+    computes the cell tables of buf: the number of points, sum, max, min and centred second moment of every cell
+    lims holds, for each axis, the list of the (lo, hi) limits of the buckets to compute, as returned by _clipped()
+    cells lie between consecutive limits (see _cell_limits()), so that every bucket is a block of cells,
+    and the tables can be shared by several bucket sizes, see bucket1d_multi() and bucket2d_multi()
+    buf is read in place, by strips of F1 cells of at most _STRIP points, so that temporaries stay small
+    peaks is an optional local maximum mask of buf, from _peak_mask(), the peaks of each cell are then counted
+    sk adds the third and fourth centred moments, for skewness and kurtosis
+    """
+    nd = buf.ndim
+    edges = [_cell_limits(l) for l in lims]
+    sizes = [np.diff(e) for e in edges]
+    starts = [e[:-1]-e[0] for e in edges]
+    shape = tuple(len(sz) for sz in sizes)
+    keys = ['sum', 'max', 'min', 'm2']
+    if peaks is not None:
+        keys.append('peaks')
+    if sk:
+        keys.extend(['m3', 'm4'])
+    tables = dict((k, np.empty(shape)) for k in keys)
+    tables['edges'] = edges
+    tables['n'] = np.prod(np.meshgrid(*sizes, indexing='ij'), axis=0)
+    rowlen = edges[1][-1]-edges[1][0] if nd == 2 else 1
+    i = 0
+    while i < shape[0]:
+        j, npts = i+1, sizes[0][i]*rowlen
+        while j < shape[0] and npts + sizes[0][j]*rowlen <= _STRIP:
+            npts += sizes[0][j]*rowlen
+            j += 1
+        sl = (slice(edges[0][i], edges[0][j]),) + tuple(slice(e[0], e[-1]) for e in edges[1:])
+        st = [starts[0][i:j]-starts[0][i]] + starts[1:]
+        def reduce(ufunc, x):
+            "reduces x over the cells of the strip"
+            for ax in range(nd):
+                x = ufunc.reduceat(x, st[ax], axis=ax)
+            return x
+        x = buf[sl]
+        total = reduce(np.add, x)
+        tables['sum'][i:j] = total
+        tables['max'][i:j] = reduce(np.maximum, x)
+        tables['min'][i:j] = reduce(np.minimum, x)
+        if peaks is not None:
+            tables['peaks'][i:j] = reduce(np.add, peaks[sl].astype(int))
+        mean = total/tables['n'][i:j]
+        for ax, sz in enumerate([sizes[0][i:j]] + sizes[1:]):     # spread back on the points
+            mean = np.repeat(mean, sz, axis=ax)
+        dev = x - mean
+        del mean
+        p = dev*dev
+        tables['m2'][i:j] = reduce(np.add, p)
+        if sk:
+            p *= dev
+            tables['m3'][i:j] = reduce(np.add, p)
+            p *= dev
+            tables['m4'][i:j] = reduce(np.add, p)
+        del dev, p
+        i = j
+    return tables
+
+def _merge_cells(cells, starts, axis):
+    """
+    merges the cell values along axis, into the groups of contiguous cells beginning at starts
+    the centred moments of the cells are shifted to the mean of their group before being summed
+    (the pairwise update of Chan, Golub and LeVeque, extended to the higher moments by Pebay),
+    which keeps the precision of a direct computation
+    """
+    if len(starts) == cells['n'].shape[axis]:      # one cell per group
+        return cells
+    def add(x):
+        "sums x over the groups"
+        return np.add.reduceat(x, starts, axis=axis)
+    n, m2 = cells['n'], cells['m2']
+    res = {'n': add(n), 'sum': add(cells['sum']),
+           'max': np.maximum.reduceat(cells['max'], starts, axis=axis),
+           'min': np.minimum.reduceat(cells['min'], starts, axis=axis)}
+    d = cells['sum']/n - np.repeat(res['sum']/res['n'], np.diff(np.r_[starts, n.shape[axis]]), axis=axis)
+    p = d*d         # powers of d as in _bucket_tables(), so that single point cells give the direct values
+    res['m2'] = add(m2 + n*p)
+    if 'm3' in cells:
+        m3 = cells['m3']
+        m4 = cells['m4'] + 4*d*m3 + 6*p*m2
+        p *= d
+        res['m3'] = add(m3 + 3*d*m2 + n*p)
+        p *= d
+        res['m4'] = add(m4 + n*p)
+    if 'peaks' in cells:
+        res['peaks'] = add(cells['peaks'])
+    return res
+
+def _bucket_stats(tables, lo, hi):
+    """
+    the values of the buckets, merged from the cell tables computed by _bucket_tables()
+    lo and hi are tuples of bucket limits, one per axis, as produced by _clipped() (decreasing order)
+    returns a dict of bucket grids: 'sum', 'max', 'min', 'std',
+        and 'peaks', 'skew', 'kurt' if the tables hold the peak counts and higher moments
+    skewness and kurtosis (Fisher) are those of scipy.stats.skew() and scipy.stats.kurtosis()
+    empty buckets get NaN values, and no peaks
+    """
+    nd = len(lo)
+    alo, ahi = [l[::-1] for l in lo], [h[::-1] for h in hi]     # ascending order
+    full = [np.nonzero(h > l)[0] for (l, h) in zip(alo, ahi)]  # removing empty buckets keeps them contiguous
+    keys = [k for k in ('sum', 'max', 'min', 'm2', 'peaks', 'm3', 'm4') if k in tables]
+    acc = dict((k, np.full(tuple(len(l) for l in lo), np.nan)) for k in keys)
+    if all(len(f) > 0 for f in full):
+        cells = dict((k, tables[k]) for k in keys + ['n'])
+        for ax in range(nd):
+            first = np.searchsorted(tables['edges'][ax], alo[ax][full[ax]])
+            last = np.searchsorted(tables['edges'][ax], ahi[ax][full[ax][-1]])
+            sl = (slice(None),)*ax + (slice(first[0], last),)
+            cells = _merge_cells(dict((k, v[sl]) for (k, v) in cells.items()), first-first[0], ax)
+        out = np.ix_(*full)
+        for k in keys:
+            acc[k][out] = cells[k]
+    stats = dict((k, np.flip(v, axis=tuple(range(nd)))) for (k, v) in acc.items())
+    npts = np.prod(np.meshgrid(*[h-l for (l, h) in zip(lo, hi)], indexing='ij'), axis=0)
+    m2 = stats.pop('m2')/npts
+    stats['std'] = np.sqrt(m2)
+    if 'peaks' in stats:
+        stats['peaks'] = np.nan_to_num(stats['peaks'])
+    if 'm3' in stats:
+        stats['skew'] = stats.pop('m3')/npts/m2**1.5
+        stats['kurt'] = stats.pop('m4')/npts/m2**2 - 3
+    return stats
+
+def _bucket1d_vector(buf, ind, bsize, tables=None, sk=False):
+    """
+    computes all the 1D bucket values in one pass
+    buf is the real 1D buffer, ind is (centers, ih, inext) as returned by _bucket_index()
+    tables are the cell tables from _bucket_tables(), with the higher moments if sk, computed here if not given
+        peaks are counted if tables holds the cell 'peaks'
+    sk adds skewness and kurtosis
+    returns a (nbuckets, ncolumns) array, in the order of the csv columns, see _columns1d()
+    """
+    centers, ih, inext = ind
+    if len(centers) == 0:
+        pp = tables is not None and 'peaks' in tables
+        return np.zeros((0, len(_columns1d(pp, sk)[0])))
+    lo, hi = _clipped(ind, len(buf))
+    if tables is None:
+        tables = _bucket_tables(buf, ([(lo, hi)],), sk=sk)
+    pp = 'peaks' in tables
+    with np.errstate(invalid='ignore', divide='ignore'):
+        st = _bucket_stats(tables, (lo,), (hi,))
+        bucket = st['sum']/((ih-inext)*bsize)
+        res = [centers, bucket, st['max'], st['min'], st['std']]
+        if pp:
+            res.append(st['peaks'])
+        if sk:
+            res.extend([st['skew'], st['kurt']])
+    res.append(ih-inext)
+    return np.column_stack(res)
+
+def _bucket2d_vector(buf, ind1, ind2, bsize, tables=None, sk=False):
+    """
+    computes all the 2D bucket values in one pass
+    buf is the real 2D buffer, ind1 and ind2 are (centers, ih, inext) as returned by _bucket_index()
+    tables are the cell tables from _bucket_tables(), with the higher moments if sk, computed here if not given
+        peaks are counted if tables holds the cell 'peaks'
+    sk adds skewness and kurtosis
+    returns a (nbuckets, ncolumns) array, in the order of the csv columns, see _columns2d()
+    """
+    bsize1, bsize2 = bsize
+    (c1, ih1, inext1), (c2, ih2, inext2) = ind1, ind2
+    if len(c1) == 0 or len(c2) == 0:
+        pp = tables is not None and 'peaks' in tables
+        return np.zeros((0, len(_columns2d(pp, sk)[0])))
+    n1, n2 = buf.shape
+    lo1, hi1 = _clipped(ind1, n1)
+    lo2, hi2 = _clipped(ind2, n2)
+    if tables is None:
+        tables = _bucket_tables(buf, ([(lo1, hi1)], [(lo2, hi2)]), sk=sk)
+    pp = 'peaks' in tables
+    with np.errstate(invalid='ignore', divide='ignore'):
+        st = _bucket_stats(tables, (lo1, lo2), (hi1, hi2))
+        area = np.outer((ih1-inext1)*bsize1, (ih2-inext2)*bsize2)
+        bucket = st['sum']/area
+        C2, C1 = np.meshgrid(c2, c1)
+        S2, S1 = np.meshgrid(ih2-inext2, ih1-inext1)
+        res = [C1, C2, bucket, st['max'], st['min'], st['std']]
+        if pp:
+            res.append(st['peaks'])
+        if sk:
+            res.extend([st['skew'], st['kurt']])
+    res.extend([S1, S2])
+    return np.column_stack([np.ravel(r) for r in res])
+
+def _header1d(data, zoom, bsize, file, columns, format='csv'):
+    "prints the header of the 1D bucket list, and returns its first line"
+    start, end = zoom
+    ppm_per_point = (data.axis1.specwidth/data.axis1.frequency/data.size1)
+    s = "# %i buckets with a mean size of %.2f data points" % \
+        ( round((end-start+bsize)/bsize), bsize/ppm_per_point)
+    if format == 'csv':
+        print(s, file=file)
+    if file is not None:    # wants the prompt on the terminal
+        print(s)
+    if format == 'csv':
+        print(", ".join(columns), file=file)
+    return s
+
+def _header2d(data, zoom, bsize, file, columns, format='csv'):
+    "prints the header of the 2D bucket list, and returns its first line"
+    start1, end1 = zoom[0]
+    start2, end2 = zoom[1]
+    bsize1, bsize2 = bsize
+    ppm_per_point1 = (data.axis1.specwidth/data.axis1.frequency/data.size1)
+    ppm_per_point2 = (data.axis2.specwidth/data.axis2.frequency/data.size2)
+    s = "# %i rectangular buckets with a mean size of %.2f x %.2f data points" % \
+        ( round((end1-start1+bsize1)/bsize1)*round((end2-start2+bsize2)/bsize2), \
+        bsize1/ppm_per_point1, bsize2/ppm_per_point2)
+    if format == 'csv':
+        print(s, file=file)
+    if file is not None:    # wants the prompt on the terminal
+        print(s)
+    if format == 'csv':
+        print(", ".join(columns), file=file)
+    return s
+
+def _axis_meta(axis):
+    "the axis calibration, as stored in npz bucket lists"
+    return np.array([axis.size, axis.specwidth, axis.offset, axis.frequency])
+
+def _meta1d(data, zoom, bsize, ind, header):
+    "the additional entries of a 1D npz bucket list"
+    centers, ih, inext = ind
+    return {'header': header, 'zoom': np.array(zoom), 'bsize': bsize, 'axis1': _axis_meta(data.axis1),
+            'center': centers, 'bucket_size': ih-inext}
+
+def _meta2d(data, zoom, bsize, ind1, ind2, header):
+    "the additional entries of a 2D npz bucket list"
+    (c1, ih1, inext1), (c2, ih2, inext2) = ind1, ind2
+    return {'header': header, 'zoom': np.array(zoom), 'bsize': np.array(bsize),
+            'axis1': _axis_meta(data.axis1), 'axis2': _axis_meta(data.axis2),
+            'centerF1': c1, 'centerF2': c2, 'bucket_size_F1': ih1-inext1, 'bucket_size_F2': ih2-inext2}
+
+def _write_buckets(res, columns, fmt, file, format='csv', meta=None):
+    """
+    writes the bucket values res - a (nbuckets, ncolumns) array
+    format is either
+        'csv' : text, one bucket per line formatted with fmt
+        'npz' : binary numpy container, at full precision
+            columns are stored by name, 2D values as (nF1, nF2) grids
+            meta holds the additional entries: axes calibration, centers, bucket sizes, ...
+            if meta holds 'row' and 'col' (see _sparse()), the list is sparse and columns are stored as vectors
+    """
+    if format == 'csv':
+        np.savetxt(file if file is not None else sys.stdout, res, fmt=fmt)
+    elif format == 'npz':
+        if file is None:
+            raise NPKError("a file is required for the npz format")
+        content = dict(meta)
+        if 'row' in content:
+            shape = (len(content['row']),)
+        elif 'centerF1' in content:
+            shape = (len(content['centerF1']), len(content['centerF2']))
+        else:
+            shape = (len(content['center']),)
+        for i, col in enumerate(columns):
+            if col not in content:
+                content[col] = res[:, i].reshape(shape)
+        content['columns'] = np.array(columns)
+        np.savez(file, **content)
+    else:
+        raise NPKError("format should be either 'csv' or 'npz'")
+
+def _sparse(res, meta, sparse, noise):
+    """
+    keeps only the significant buckets of the 2D bucket list res,
+    those holding a point larger (in absolute value) than sparse*noise
+    returns the reduced res and meta, completed with the (row, col) grid coordinates of the kept buckets
+    and the noise floor
+    """
+    level = np.maximum(np.abs(res[:, 3]), np.abs(res[:, 4]))     # max and min columns
+    keep = np.nonzero(level > sparse*noise)[0]
+    n2 = len(meta['centerF2'])
+    meta = dict(meta, row=keep//n2, col=keep%n2, noise=noise, sparse=sparse)
+    return res[keep], meta
+
+def _sparse_noise(buf, sparse, noise, format):
+    "checks the sparse parameters, and returns the noise floor of buf used by _sparse()"
+    if sparse > 0 and format != 'npz':
+        raise NPKError("sparse bucket lists require the npz format")
+    if sparse > 0 and noise is None:
+        noise = _noiselevel(buf, flat=True)
+    return noise
+
+def _columns(columns, fmt, pp, sk):
+    "adds the optional peak number, skewness and kurtosis columns to the (columns, fmt) lists"
+    if pp:
+        columns, fmt = columns + ["peaks_nb"], fmt + ["%d"]
+    if sk:
+        columns, fmt = columns + ["skewness", "kurtosis"], fmt + ["%.3f", "%.3f"]
+    return columns, fmt
+
+def _columns1d(pp=False, sk=False):
+    "the column names and the csv format of a 1D bucket list"
+    columns, fmt = _columns(["center", "bucket", "max", "min", "std"], ["%.3f", "%.1f", "%.1f", "%.1f", "%.1f"], pp, sk)
+    return columns + ["bucket_size"], ", ".join(fmt + ["%d"])
+
+def _columns2d(pp=False, sk=False):
+    "the column names and the csv format of a 2D bucket list"
+    columns, fmt = _columns(["centerF1", "centerF2", "bucket", "max", "min", "std"],
+                        ["%.3f", "%.3f", "%.1f", "%.1f", "%.1f", "%.1f"], pp, sk)
+    return columns + ["bucket_size_F1", "bucket_size_F2"], ", ".join(fmt + ["%d", "%d"])
+
+def _peaks(buf, pp, thresh):
+    "the local maximum mask used to count the peaks - None if pp is False"
+    if not pp:
+        return None
+    noise = _noiselevel(buf)
+    return _peak_mask(buf, thresh*noise)
+
+#---------------------------------------------------------------------------
+def bucket1d(data, zoom=(0.5, 9.5), bsize=0.04, pp=False, sk=False, thresh=10, file=None, engine='vector', format='csv',
+        mapdir=None, bmap=None):
     """
  This tool permits to realize a bucket integration from the current 1D data-set.
  You will have to determine  (all spectral values are in ppm)
    - zoom (low,high),  : the starting and ending ppm of the integration zone in the spectrum
    - bsize: the size of the bucket
+   - pp: if True, the number of peaks in the bucket is also added
+        - peaks are detected if intensity is larger that thresh*noise
+   - sk: if True, skewness and kurtosis computed for each bucket
    - file: the filename to which the result is written
+   - engine: 'vector' (default) computes all buckets at once with ufunc.reduceat(),
+             'loop' is the original bucket by bucket code, kept for checking
+   - format: 'csv' (default) writes a text file,
+             'npz' writes a binary numpy file, at full precision, with the axis calibration
+             (file should then be opened in binary mode) - load it with BucketUtilities
+   - mapdir: if given, the bucket boundaries (see BucketMap) are stored in this directory,
+             and reused by all the spectra with the same calibration - they are always cached in memory
+   - bmap: adaptive buckets, as returned by adaptive_buckets() with the same zoom and bsize,
+           used instead of the regular buckets - vector engine only
 
 
  For a better bucket integration, you should be careful that :
@@ -39,15 +619,31 @@ def bucket1d(data, zoom=(0.5, 9.5), bsize=0.04, file=None):
     ppm_per_point = (data.axis1.specwidth/data.axis1.frequency/data.size1)
     if (bsize < 2*ppm_per_point):        NPKError( "Bucket size smaller than digital resolution !")
 
+    columns, fmt = _columns1d(pp, sk)
+    if engine == 'vector':
+        buf, (axis1,) = _real_view(data)    # the buffer is only read, no copy needed
+        header = _header1d(data, zoom, bsize, file, columns, format)
+        ind, widths = _map_index(axis1, start, end, bsize, bmap, mapdir)
+        tables = None
+        if len(ind[0]) > 0:
+            peaks = _peaks(buf, pp, thresh)
+            tables = _bucket_tables(buf, ([_clipped(ind, len(buf))],), peaks, sk)
+        res = _bucket1d_vector(buf, ind, widths, tables, sk)
+        _write_buckets(res, columns, fmt, file, format, _meta1d(data, zoom, bsize, ind, header))
+        return data
+    elif engine != 'loop':
+        raise NPKError("engine should be either 'vector' or 'loop'")
+    elif format != 'csv':
+        raise NPKError("the loop engine only produces csv")
+    elif bmap is not None:
+        raise NPKError("the loop engine only computes regular buckets")
     dcopy = data.copy()   # work now on a real version of the data
     dcopy.real(axis=1)
-
-    s = "# %i buckets with a mean size of %.2f data points" % \
-        ( round((end-start+bsize)/bsize), bsize/ppm_per_point)
-    print(s, file=file)
-    if file is not None:    # wants the prompt on the terminal
-        print(s)
-    print("center, bucket, max, min, std, bucket_size", file=file)
+    if pp:
+        noise = findnoiselevel( dcopy.get_buffer() )
+        dcopy.pp(thresh*noise)
+        peaklist = dcopy.peaks.pos
+    _header1d(data, zoom, bsize, file, columns)
     there = max(start,end)   # end of the bucket region
     here = min(start,end)    # running center of the bucket - initialized to begining
     here2 = (here-bsize/2)   # running beginning of the bucket
@@ -57,26 +653,52 @@ def bucket1d(data, zoom=(0.5, 9.5), bsize=0.04, file=None):
         inext = (round(dcopy.axis1.ptoi(next))) # int of running en of bucket
         if ih<0 or inext<0:
             break
-        integ = dcopy.buffer[inext:ih].sum()
+        lbuf = dcopy.buffer[inext:ih]
+        integ = lbuf.sum()
         try:
-            maxv = dcopy.buffer[inext:ih].max()
-            minv = dcopy.buffer[inext:ih].min()
+            maxv = lbuf.max()
+            minv = lbuf.min()
         except ValueError:
             maxv = np.NaN     # sum and std returns nan - max returns an error ???
             minv = np.NaN     # sum and std returns nan - min returns an error ???
-        stdv = dcopy.buffer[inext:ih].std()
-        print("%.3f, %.1f, %.1f, %.1f, %.1f, %d"%(here, integ/((ih-inext)*bsize), maxv, minv, stdv,  (ih-inext) ), file=file)
+        stdv = lbuf.std()
+        bkvlist = "%.3f, %.1f, %.1f, %.1f, %.1f"%(here, integ/((ih-inext)*bsize), maxv, minv, stdv)
+        if pp:
+            pk = np.where((peaklist>=inext)&(peaklist<ih))
+            bkvlist = "%s, %d"%(bkvlist, len(pk[0]))
+        if sk:
+            skew = stats.skew(lbuf)
+            kurt = stats.kurtosis(lbuf)
+            bkvlist = "%s, %.3f, %.3f"%(bkvlist, skew, kurt)
+        print("%s, %d"%(bkvlist, (ih-inext) ), file=file)
         here2 = next
         here = (here+bsize)
     return data
 #---------------------------------------------------------------------------
-def bucket2d(data, zoom=((0.5, 9.5),(0.5, 9.5)), bsize=(0.1, 0.1), file=None):
+def bucket2d(data, zoom=((0.5, 9.5),(0.5, 9.5)), bsize=(0.1, 0.1), pp=False, sk=False, thresh=10, file=None, engine='vector', format='csv',
+        sparse=0, noise=None, mapdir=None, bmap=None):
     """
  This tool permits to realize a bucket integration from the current 2D data-set.
  You will have to determine  (all spectral values are in ppm)
    - zoom (F1limits, F2limits),  : the starting and ending ppm of the integration zone in the spectrum
    - bsize (F1,F2): the sizes of the bucket
+   - pp: if True, the number of peaks in the bucket is also added
+        - peaks are detected if intensity is larger that thresh*noise
+   - sk: if True, skewness and kurtosis computed for each bucket
    - file: the filename to which the result is written
+   - engine: 'vector' (default) computes all buckets at once from cell tables,
+             'loop' is the original bucket by bucket code, kept for checking
+   - format: 'csv' (default) writes a text file,
+             'npz' writes a binary numpy file, at full precision, with the axis calibration
+             (file should then be opened in binary mode) - load it with BucketUtilities
+   - sparse: if > 0, only the buckets holding a point larger than sparse*noise are stored,
+             as (row, col) grid coordinates along with their values, and the noise floor (npz format only)
+             BucketUtilities densifies them on loading
+   - noise: the noise level used by sparse, computed with findnoiselevel() if None
+   - mapdir: if given, the bucket boundaries (see BucketMap) are stored in this directory,
+             and reused by all the spectra with the same calibration - they are always cached in memory
+   - bmap: (F1, F2) adaptive buckets, as returned by adaptive_buckets() with the same zoom and bsize,
+           used instead of the regular buckets - vector engine only
 
 
  For a better bucket integration, you should be careful that :
@@ -101,17 +723,38 @@ def bucket2d(data, zoom=((0.5, 9.5),(0.5, 9.5)), bsize=(0.1, 0.1), file=None):
     if (bsize1 < 2*ppm_per_point1):        NPKError( "Bucket size smaller than digital resolution !")
     if (bsize2 < 2*ppm_per_point2):        NPKError( "Bucket size smaller than digital resolution !")
 
+    columns, fmt = _columns2d(pp, sk)
+    if engine == 'vector':
+        buf, (axis1, axis2) = _real_view(data)    # the buffer is only read, no copy needed
+        noise = _sparse_noise(buf, sparse, noise, format)
+        header = _header2d(data, zoom, bsize, file, columns, format)
+        bmap1, bmap2 = bmap if bmap is not None else (None, None)
+        ind1, widths1 = _map_index(axis1, start1, end1, bsize1, bmap1, mapdir)
+        ind2, widths2 = _map_index(axis2, start2, end2, bsize2, bmap2, mapdir)
+        tables = None
+        if len(ind1[0]) > 0 and len(ind2[0]) > 0:
+            peaks = _peaks(buf, pp, thresh)
+            tables = _bucket_tables(buf, ([_clipped(ind1, buf.shape[0])], [_clipped(ind2, buf.shape[1])]), peaks, sk)
+        res = _bucket2d_vector(buf, ind1, ind2, (widths1, widths2), tables, sk)
+        meta = _meta2d(data, zoom, bsize, ind1, ind2, header)
+        if sparse > 0:
+            res, meta = _sparse(res, meta, sparse, noise)
+        _write_buckets(res, columns, fmt, file, format, meta)
+        return data
+    elif engine != 'loop':
+        raise NPKError("engine should be either 'vector' or 'loop'")
+    elif format != 'csv':
+        raise NPKError("the loop engine only produces csv")
+    elif bmap is not None:
+        raise NPKError("the loop engine only computes regular buckets")
     dcopy = data.copy()   # work now on a real version of the data
     dcopy.real(axis=2)
     dcopy.real(axis=1)
-
-    s = "# %i rectangular buckets with a mean size of %.2f x %.2f data points" % \
-        ( round((end1-start1+bsize1)/bsize1)*round((end2-start2+bsize2)/bsize2), \
-        bsize1/ppm_per_point1, bsize2/ppm_per_point2)
-    print(s, file=file)
-    if file is not None:    # wants the prompt on the terminal
-        print(s)
-    print("centerF1, centerF2, bucket, max, min, std, bucket_size_F1, bucket_size_F2", file=file)
+    if pp:
+        noise = findnoiselevel( dcopy.get_buffer() )
+        dcopy.pp(thresh*noise)
+        peaklist = dcopy.peaks
+    _header2d(data, zoom, bsize, file, columns)
     here1 = min(start1, end1)
     here1_2 = (here1-bsize1/2)
     there1 = max(start1, end1)
@@ -131,16 +774,26 @@ def bucket2d(data, zoom=((0.5, 9.5),(0.5, 9.5)), bsize=(0.1, 0.1), file=None):
             inext2 = int(round(dcopy.axis2.ptoi(next2)))
             if ih2<0 or inext2<0:
                 break
-            integ = dcopy.buffer[inext1:ih1, inext2:ih2].sum()
+            lbuf = dcopy.buffer[inext1:ih1, inext2:ih2]
+            integ = lbuf.sum()
             area = ((ih1-inext1)*bsize1) * ((ih2-inext2)*bsize2)
             try:
-                maxv = dcopy.buffer[inext1:ih1, inext2:ih2].max()
-                minv = dcopy.buffer[inext1:ih1, inext2:ih2].max()
+                maxv = lbuf.max()
+                minv = lbuf.min()
             except ValueError:
                 maxv = np.NaN     # sum and std returns nan - max returns an error ???
-                minv = np.NaN     # sum and std returns nan - max returns an error ???
-            stdv = dcopy.buffer[inext1:ih1, inext2:ih2].std()
-            print("%.3f, %.3f, %.1f, %.1f, %.1f, %.1f, %d, %d"%(here1, here2, integ/area, maxv, minv, stdv, (ih1-inext1), (ih2-inext2) ), file=file)
+                minv = np.NaN     # sum and std returns nan - min returns an error ???
+            stdv = lbuf.std()
+            bkvlist = "%.3f, %.3f, %.1f, %.1f, %.1f, %.1f"%(here1, here2, integ/area, maxv, minv, stdv )
+            if pp:
+                pk1 = [pk for pk in peaklist if (pk.posF1>=inext1 and pk.posF1<ih1) ] # peaks in F1
+                pk12 = [pk for pk in pk1 if (pk.posF2>=inext2 and pk.posF2<ih2) ]
+                bkvlist = "%s, %d"%(bkvlist, len(pk12))
+            if sk:
+                skew = stats.skew(lbuf.ravel())
+                kurt = stats.kurtosis(lbuf.ravel())
+                bkvlist = "%s, %.3f, %.3f"%(bkvlist, skew, kurt)
+            print("%s, %d, %d"%(bkvlist, (ih1-inext1), (ih2-inext2) ), file=file)
 #            print(here1, here2, here1_2, here2_2, inext1, ih1, inext2, ih2, file=F)
             here2_2 = next2
             here2 = (here2+bsize2)
@@ -149,6 +802,118 @@ def bucket2d(data, zoom=((0.5, 9.5),(0.5, 9.5)), bsize=(0.1, 0.1), file=None):
 
     return data
 
+#---------------------------------------------------------------------------
+def adaptive_buckets(data, zoom=(0.5, 9.5), bsize=0.04, window=0.3, series=None):
+    """
+ This tool computes adaptive buckets, with edges located at the minima of the current data-set, used as a reference.
+ The regular buckets of size bsize are first built, then each edge is moved to the deepest local minimum
+ of the reference found within +/- window*bsize, so that peaks are no more split between buckets.
+   - zoom: the starting and ending ppm of the integration zone,  (F1limits, F2limits) in 2D
+   - bsize: the nominal size of the bucket, (F1,F2) in 2D
+   - window: the search zone around each edge, in fraction of bsize, within ]0, 0.5[
+   - series: an optional list of data-sets, the minima are then searched on the mean of data and series
+             (all with the calibration of data)
+   in 2D, the minima are searched on the skyline projections of the reference along each axis
+
+ returns a BucketMap in 1D, a (F1, F2) pair of BucketMap in 2D, to be passed as bmap to bucket1d() / bucket2d()
+ for every spectrum of the series - calibration offsets (as set by autozero) are handled
+    """
+    ref, axes = _real_view(data)
+    if series:
+        ref = np.mean([ref] + [_real_view(d)[0] for d in series], axis=0)
+    if data.dim == 1:
+        start, end = zoom
+        return _adaptive_map(ref, axes[0], start, end, bsize, window)
+    elif data.dim == 2:
+        (start1, end1), (start2, end2) = zoom
+        bsize1, bsize2 = bsize
+        return (_adaptive_map(ref.max(axis=1), axes[0], start1, end1, bsize1, window),
+                _adaptive_map(ref.max(axis=0), axes[1], start2, end2, bsize2, window))
+    else:
+        raise NPKError("adaptive_buckets is only implemented in 1D and 2D")
+#---------------------------------------------------------------------------
+def bucket1d_multi(data, zoom=(0.5, 9.5), bsizes=(0.01, 0.02, 0.04), pp=False, sk=False, thresh=10, files=None, format='csv',
+        mapdir=None):
+    """
+ This tool realizes several bucket integrations of the current 1D data-set, one for each bucket size.
+ The spectrum is scanned only once: the cell tables (see _bucket_tables()) are built on the limits of all the sizes,
+ along with the peak detection, then the buckets of each size are merged from these cells,
+ at a cost which depends on the number of cells only, not on the size of the spectrum.
+   - zoom (low,high),  : the starting and ending ppm of the integration zone in the spectrum
+   - bsizes: a list of bucket sizes
+   - pp, sk, thresh: peak number, skewness and kurtosis, see bucket1d()
+   - files: a list of files, one per bucket size, to which the results are written
+            if None, all results are printed on the terminal
+   - format: 'csv' or 'npz', see bucket1d()
+   - mapdir: bucket boundaries storage, see bucket1d()
+
+ each output is identical to the one produced by bucket1d() with the corresponding size
+    """
+    data.check1D()
+    start, end = zoom
+    if files is None:
+        files = [None]*len(bsizes)
+    if len(files) != len(bsizes):
+        raise NPKError("bucket1d_multi needs one file per bucket size")
+    buf, (axis1,) = _real_view(data)    # the buffer is only read, no copy needed
+
+    inds = [_bucket_index(axis1, start, end, bsize, mapdir) for bsize in bsizes]
+    lims = [_clipped(ind, len(buf)) for ind in inds if len(ind[0]) > 0]
+    tables = None
+    if lims:
+        tables = _bucket_tables(buf, (lims,), _peaks(buf, pp, thresh), sk)
+    columns, fmt = _columns1d(pp, sk)
+    for bsize, ind, file in zip(bsizes, inds, files):
+        header = _header1d(data, zoom, bsize, file, columns, format)
+        res = _bucket1d_vector(buf, ind, bsize, tables, sk)
+        _write_buckets(res, columns, fmt, file, format, _meta1d(data, zoom, bsize, ind, header))
+    return data
+#---------------------------------------------------------------------------
+def bucket2d_multi(data, zoom=((0.5, 9.5),(0.5, 9.5)), bsizes=((0.1, 0.1), (0.2, 0.2)), pp=False, sk=False, thresh=10, files=None, format='csv',
+        sparse=0, noise=None, mapdir=None):
+    """
+ This tool realizes several bucket integrations of the current 2D data-set, one for each bucket size.
+ The spectrum is scanned only once: the cell tables (see _bucket_tables()) are built on the limits of all the sizes,
+ along with the peak detection, then the buckets of each size are merged from these cells,
+ at a cost which depends on the number of cells only, not on the size of the spectrum.
+   - zoom (F1limits, F2limits),  : the starting and ending ppm of the integration zone in the spectrum
+   - bsizes: a list of (F1,F2) bucket sizes
+   - pp, sk, thresh: peak number, skewness and kurtosis, see bucket2d()
+   - files: a list of files, one per bucket size, to which the results are written
+            if None, all results are printed on the terminal
+   - format: 'csv' or 'npz', see bucket2d()
+   - sparse, noise: sparse bucket lists, see bucket2d()
+   - mapdir: bucket boundaries storage, see bucket2d()
+
+ each output is identical to the one produced by bucket2d() with the corresponding size
+    """
+    data.check2D()
+    start1, end1 = zoom[0]
+    start2, end2 = zoom[1]
+    if files is None:
+        files = [None]*len(bsizes)
+    if len(files) != len(bsizes):
+        raise NPKError("bucket2d_multi needs one file per bucket size")
+    buf, (axis1, axis2) = _real_view(data)    # the buffer is only read, no copy needed
+    noise = _sparse_noise(buf, sparse, noise, format)
+
+    inds1 = [_bucket_index(axis1, start1, end1, bsize1, mapdir) for (bsize1, bsize2) in bsizes]
+    inds2 = [_bucket_index(axis2, start2, end2, bsize2, mapdir) for (bsize1, bsize2) in bsizes]
+    lims1 = [_clipped(ind, buf.shape[0]) for ind in inds1 if len(ind[0]) > 0]
+    lims2 = [_clipped(ind, buf.shape[1]) for ind in inds2 if len(ind[0]) > 0]
+    tables = None
+    if lims1 and lims2:
+        tables = _bucket_tables(buf, (lims1, lims2), _peaks(buf, pp, thresh), sk)
+    columns, fmt = _columns2d(pp, sk)
+    for bsize, ind1, ind2, file in zip(bsizes, inds1, inds2, files):
+        header = _header2d(data, zoom, bsize, file, columns, format)
+        res = _bucket2d_vector(buf, ind1, ind2, bsize, tables, sk)
+        meta = _meta2d(data, zoom, bsize, ind1, ind2, header)
+        if sparse > 0:
+            res, meta = _sparse(res, meta, sparse, noise)
+        _write_buckets(res, columns, fmt, file, format, meta)
+    return data
+
 
 class BucketingTests(unittest.TestCase):
     def setUp(self):
@@ -164,5 +929,171 @@ class BucketingTests(unittest.TestCase):
         y = math.log(1.0)
         self.assertAlmostEqual(x, y )
 
+    def _data(self, dim=2, cpx=False, n1=128, n2=512, seed=0):
+        "a synthetic 1D or 2D spectrum over 0-10 ppm, with a few peaks on noise - complex axes if cpx"
+        from spike.NMR import NMRData
+        rng = np.random.RandomState(seed)
+        shape = (n2,) if dim == 1 else (n1, n2)
+        if cpx:
+            shape = tuple(2*n for n in shape)
+        b = rng.randn(*shape)
+        for k in range(12):
+            pos = tuple(rng.randint(n) for n in shape)
+            b[tuple(slice(max(0, i-3), i+3) for i in pos)] += 100*rng.rand()
+        d = NMRData(buffer=b)
+        for i in range(1, dim+1):
+            ax = d.axes(i)
+            ax.frequency, ax.specwidth, ax.offset = 400.0, 4000.0, 0.0
+            if cpx:
+                ax.itype = 1
+        return d
+    def _csv(self, d, **kw):
+        "the csv bucket list of d as a list of lines"
+        import io
+        f = io.StringIO()
+        if d.dim == 1:
+            d.bucket1d(zoom=(0.3, 9.5), bsize=0.1, file=f, **kw)
+        else:
+            d.bucket2d(zoom=((0.3, 9.5), (0.2, 9.7)), bsize=(0.3, 0.1), file=f, **kw)
+        return f.getvalue().splitlines()
+    def test_engines(self):
+        "the vector engine produces the csv of the loop engine, in 1D and 2D, on real and complex data"
+        self.announce()
+        for dim in (1, 2):
+            for cpx in (False, True):
+                d = self._data(dim, cpx)
+                for pp in (False, True):
+                    for sk in (False, True):
+                        ref = self._csv(d, engine='loop', pp=pp, sk=sk)
+                        self.assertEqual(self._csv(d, engine='vector', pp=pp, sk=sk), ref)
+                self.assertTrue(np.all(d.buffer == self._data(dim, cpx).buffer))     # the spectrum is only read
+        self.assertRaises(NPKError, self._csv, d, engine='nope')
+    def test_formats(self):
+        "npz bucket lists hold the values of the csv"
+        self.announce()
+        import io
+        d = self._data(2)
+        columns, fmt = _columns2d(pp=True, sk=True)
+        lines = self._csv(d, pp=True, sk=True)[2:]
+        f = io.BytesIO()
+        d.bucket2d(zoom=((0.3, 9.5), (0.2, 9.7)), bsize=(0.3, 0.1), file=f, format='npz', pp=True, sk=True)
+        f.seek(0)
+        with np.load(f) as F:
+            self.assertEqual(list(F['columns']), columns)
+            n1, n2 = F['bucket'].shape
+            C1, C2 = np.meshgrid(F['centerF1'], F['centerF2'], indexing='ij')
+            S1, S2 = np.meshgrid(F['bucket_size_F1'], F['bucket_size_F2'], indexing='ij')
+            grids = dict(centerF1=C1, centerF2=C2, bucket_size_F1=S1, bucket_size_F2=S2)
+            res = np.stack([grids[c] if c in grids else F[c] for c in columns], axis=-1).reshape(n1*n2, len(columns))
+        self.assertEqual([fmt%tuple(r) for r in res], lines)
+        self.assertRaises(NPKError, self._csv, d, format='npz', engine='loop')
+    def test_sparse(self):
+        "sparse npz bucket lists hold the significant buckets of the full list, with bucket2d and bucket2d_multi"
+        self.announce()
+        import io
+        d = self._data(2)
+        zoom, bsize = ((0.3, 9.5), (0.2, 9.7)), (0.3, 0.1)
+        lists = {}
+        for sparse in (0, 20):
+            f = io.BytesIO()
+            d.bucket2d(zoom=zoom, bsize=bsize, file=f, format='npz', pp=True, sk=True, sparse=sparse, noise=2.0)
+            f.seek(0)
+            with np.load(f) as F:
+                lists[sparse] = dict(F)
+        full, F = lists[0], lists[20]
+        self.assertEqual(float(F['noise']), 2.0)
+        n1, n2 = full['bucket'].shape
+        keep = F['row']*n2 + F['col']
+        self.assertTrue(0 < len(keep) < n1*n2)
+        level = np.maximum(abs(full['max']), abs(full['min'])).ravel()
+        self.assertTrue(np.array_equal(keep, np.nonzero(level > 40.0)[0]))
+        for c in ('bucket', 'max', 'min', 'std', 'peaks_nb', 'skewness', 'kurtosis'):
+            self.assertTrue(np.array_equal(F[c], full[c].ravel()[keep]))
+        self.assertRaises(NPKError, self._csv, d, sparse=20)
+        for dc in (d, self._data(2, cpx=True)):     # the default noise floor is findnoiselevel() of the spectrum
+            f = io.BytesIO()
+            dc.bucket2d(zoom=zoom, bsize=bsize, file=f, format='npz', sparse=20)
+            f.seek(0)
+            with np.load(f) as F:
+                self.assertEqual(float(F['noise']), findnoiselevel(_real_view(dc)[0].ravel()))
+        # the multi-size lists keep the same buckets
+        bsizes = (bsize, (0.5, 0.2))
+        files = [io.BytesIO() for b in bsizes]
+        d.bucket2d_multi(zoom=zoom, bsizes=bsizes, files=files, format='npz', sparse=5, noise=1.0)
+        for bsize, f in zip(bsizes, files):
+            ref = io.BytesIO()
+            d.bucket2d(zoom=zoom, bsize=bsize, file=ref, format='npz', sparse=5, noise=1.0)
+            f.seek(0); ref.seek(0)
+            with np.load(f) as F, np.load(ref) as R:
+                for name in ('row', 'col', 'max', 'min'):
+                    self.assertTrue(np.array_equal(F[name], R[name]))
+                for name in ('bucket', 'std'):
+                    self.assertTrue(np.allclose(F[name], R[name]))
+    def test_offset(self):
+        "a cached BucketMap is shifted for an axis with another offset"
+        self.announce()
+        d = self._data(2)
+        self._csv(d)                    # the maps are built and cached with offset 0
+        d.axis1.offset, d.axis2.offset = 37.3, -121.7
+        for ax, (start, end, bsize) in ((d.axis1, (0.3, 9.5, 0.3)), (d.axis2, (0.2, 9.7, 0.1))):
+            shifted = bucket_map(ax, start, end, bsize).index(ax)
+            fresh = BucketMap(ax, start, end, bsize).index(ax)
+            for a, b in zip(shifted, fresh):
+                self.assertTrue(np.array_equal(a, b))
+        self.assertEqual(self._csv(d, pp=True), self._csv(d, engine='loop', pp=True))
+        d.axis2.specwidth = 3000.0
+        self.assertRaises(NPKError, BucketMap(d.axis1, 0.3, 9.5, 0.3).check, d.axis2)
+    def test_adaptive(self):
+        "adaptive edges are moved to local minima of the reference, within the window"
+        self.announce()
+        d = self._data(1)
+        ref, (axis,) = _real_view(d)
+        regular = BucketMap(axis, 0.3, 9.5, 0.1)
+        bmap = d.adaptive_buckets(zoom=(0.3, 9.5), bsize=0.1, window=0.3)
+        self.assertEqual(len(bmap.edges), len(regular.edges))
+        self.assertEqual(bmap.edges[0], regular.edges[0])
+        self.assertEqual(bmap.edges[-1], regular.edges[-1])
+        self.assertTrue(np.all(abs(bmap.edges-regular.edges) <= 0.3*0.1 + 1E-9))
+        self.assertTrue(np.all(np.diff(bmap.edges) > 0))
+        moved = np.nonzero(bmap.edges != regular.edges)[0]
+        self.assertTrue(len(moved) > 0)
+        for i in np.round(bmap.pos[moved]).astype(int):
+            self.assertTrue(ref[i] <= ref[i-1] and ref[i] <= ref[i+1])
+        self.assertTrue(np.allclose(bmap.widths, np.diff(bmap.edges)))
+        lines = self._csv(d, bmap=bmap)
+        self.assertEqual(len(lines), len(self._csv(d)))
+        sizes = np.array([int(l.split(',')[-1]) for l in lines[2:]])
+        self.assertEqual(sizes.sum(), np.round(regular.pos[0]).astype(int) - np.round(regular.pos[-1]).astype(int))
+        self.assertRaises(NPKError, self._csv, d, bmap=bmap, engine='loop')
+        self.assertRaises(NPKError, d.adaptive_buckets, zoom=(0.3, 9.5), bsize=0.1, window=0.6)
+        # 2D, and the mean of a series as reference
+        d2 = self._data(2)
+        bmap1, bmap2 = d2.adaptive_buckets(zoom=((0.3, 9.5), (0.2, 9.7)), bsize=(0.3, 0.1), series=[self._data(2, seed=1)])
+        self.assertEqual(len(self._csv(d2, bmap=(bmap1, bmap2))), len(self._csv(d2)))
+    def test_multi(self):
+        "bucket*_multi produce the bucket lists of single size runs"
+        self.announce()
+        import io
+        for dim, bsizes in ((1, (0.05, 0.1, 0.2)), (2, ((0.3, 0.1), (0.5, 0.2)))):
+            d = self._data(dim)
+            zoom = (0.3, 9.5) if dim == 1 else ((0.3, 9.5), (0.2, 9.7))
+            for kw in (dict(), dict(pp=True, sk=True)):
+                files = [io.StringIO() for b in bsizes]
+                if dim == 1:
+                    d.bucket1d_multi(zoom=zoom, bsizes=bsizes, files=files, **kw)
+                else:
+                    d.bucket2d_multi(zoom=zoom, bsizes=bsizes, files=files, **kw)
+                for bsize, f in zip(bsizes, files):
+                    ref = io.StringIO()
+                    if dim == 1:
+                        d.bucket1d(zoom=zoom, bsize=bsize, file=ref, **kw)
+                    else:
+                        d.bucket2d(zoom=zoom, bsize=bsize, file=ref, **kw)
+                    self.assertEqual(f.getvalue(), ref.getvalue())
+        self.assertRaises(NPKError, d.bucket2d_multi, zoom=zoom, bsizes=bsizes, files=files[:1])
+
 NPKData_plugin("bucket1d", bucket1d)
 NPKData_plugin("bucket2d", bucket2d)
+NPKData_plugin("bucket1d_multi", bucket1d_multi)
+NPKData_plugin("bucket2d_multi", bucket2d_multi)
+NPKData_plugin("adaptive_buckets", adaptive_buckets)
@@ -18,7 +18,9 @@ Licence: CC-BY-NC-SA   https://creativecommons.org/licenses/by-nc-sa/4.0/
 from __future__ import print_function, division
 
 import sys
+import os
 import os.path as op
+import hashlib
 import unittest
 import re
 
@@ -80,7 +82,7 @@ def approx_lambert(x):
     does not overflow !     does not NaN
     """
     limit = 50
-    nz = np.nonzero( (x < limit) )[0]
+    nz = (x < limit)            # a mask, so that x can be a vector or a block of columns
     A = 0.00303583748046
     s = x*(1 - np.log(x)/(1+x)) + A/(1+x-limit)**0.75
     s[nz] = lambert_w(np.exp(x[nz]))
@@ -101,9 +103,9 @@ def prox_l1(x, w) :
     Compute proximity operator of L1 norm"
     """
     p = np.zeros_like(x)
-    pos = np.nonzero(x>w)[0]
+    pos = (x>w)
     p[pos] = x[pos] - w
-    neg = np.nonzero(x<-w)[0]
+    neg = (x<-w)
     p[neg] = x[neg] + w
     return p
 
@@ -111,9 +113,10 @@ def prox_l2(x, dx, eta) :
     """
     Compute projection of x onto l2 ball ||z-dx||<=eta
     x and dx are image vectors  
+    x and dx can also be (M, B) blocks of B columns, each projected on its own ball, eta being then a vector of B values
     """
     t = x-dx
-    s = t*np.minimum(eta/np.linalg.norm(t),1)
+    s = t*np.minimum(eta/np.linalg.norm(t, axis=0),1)
     return x + s - t
 
 def prox_l1_Sent(x, lamda, a):
@@ -134,7 +137,7 @@ def PPXAplus(K, Binv, y, eta, nbiter=1000, lamda=0.1, prec=1E-12, full_output=Fa
     r"""
     performs the PPXA+ algorithm
     K : a MxN matrix which transform from data space to image space
-    Binv : inverse of (Id + K.t K)
+    Binv : inverse of (Id + K.t K), either as a dense NxN matrix or as a WoodburyBinv operator
     y : a M vector containing the data
     a : an estimate of $\sum{x}$ where x is final image - used as a bayesian prior of x
     eta : an estimate of the standard deviation of the noise in y
@@ -174,13 +177,13 @@ def PPXAplus(K, Binv, y, eta, nbiter=1000, lamda=0.1, prec=1E-12, full_output=Fa
     x_n_old = x0.copy()
     tmp1 = x0.copy()
     tmp2 = np.dot(K,x0)
-    x_n = np.dot(Binv,tmp1 + np.dot(Kt,tmp2))
+    x_n = Binv.dot(tmp1 + np.dot(Kt,tmp2))
     # 2.2 loop
     n = 0
     for n in range(0,nbiter):
         xx1 = prox_l1_Sent(tmp1, lamda, a)   # L1 + Shannon
         xx2 = prox_l2(tmp2, y, eta)
-        c = np.dot(Binv, xx1 + np.dot(Kt,xx2))
+        c = Binv.dot(xx1 + np.dot(Kt,xx2))
         cmxn = c - x_n
         c2mxn = c + cmxn
         tmp1 += gamma*(c2mxn - xx1)
@@ -206,6 +209,107 @@ def PPXAplus(K, Binv, y, eta, nbiter=1000, lamda=0.1, prec=1E-12, full_output=Fa
         comp = n        # number of iterations
     return x_n, comp
 
+def PPXAplus_batch(K, Binv, Y, eta, nbiter=1000, lamda=0.1, prec=1E-12, init=None, full_state=False):
+    r"""
+    performs the PPXA+ algorithm on a block of columns at once
+    same as PPXAplus(), but
+    Y : a (M, B) block containing B data columns
+    eta : a vector of B estimates of the standard deviation of the noise, one for each column
+    all columns are iterated together with matrix-matrix products,
+    and each column is removed from the computation as soon as it has converged (or produced NaN)
+    init : if given, the (X, T1, T2) state from which the iteration starts (warm start), instead of a flat image
+        X the (N, B) images, T1 (N, B) and T2 (M, B) the PPXA+ auxiliary variables, as returned with full_state
+    returns
+    (X, comp), where X is the (N, B) block of computed images and comp the number of iterations of each column
+    or (X, comp, (X, T1, T2)) if full_state is True
+    """
+    # 1 - scaling step, column-wise
+    Y = np.asarray(Y, dtype=float)
+    M,N = K.shape
+    B = Y.shape[1]
+    scale = Y[0].copy()
+    y = Y / scale
+    eta = np.asarray(eta, dtype=float)*np.ones(B) / scale
+    a = y[0].copy()
+    # 2 - PPXA+
+    # 2.1 preparation
+    gamma = 1.99
+    X = np.zeros((N,B))
+    comp = np.zeros(B, dtype=int)
+    active = np.arange(B)        # the columns still iterated
+    Kt = K.T
+    if init is None:
+        x0 = np.ones((N,B))
+        x0 *= np.sum(y, axis=0) / (M*N)
+        x_n_old = x0.copy()
+        tmp1 = x0.copy()
+        tmp2 = np.dot(K,x0)
+        x_n = Binv.dot(tmp1 + np.dot(Kt,tmp2))
+    else:   # the state is stored unscaled
+        x_n = init[0] / scale
+        tmp1 = init[1] / scale
+        tmp2 = init[2] / scale
+        x_n_old = x_n.copy()
+    T1 = np.zeros((N,B))
+    T2 = np.zeros((M,B))
+    # 2.2 loop
+    for n in range(0,nbiter):
+        xx1 = prox_l1_Sent(tmp1, lamda, a)   # L1 + Shannon
+        xx2 = prox_l2(tmp2, y, eta)
+        c = Binv.dot(xx1 + np.dot(Kt,xx2))
+        cmxn = c - x_n
+        c2mxn = c + cmxn
+        tmp1 += gamma*(c2mxn - xx1)
+        tmp2 += gamma*(np.dot(K, c2mxn) - xx2)
+        x_n += gamma*cmxn
+        n_x_n = np.linalg.norm(x_n-x_n_old, axis=0) / np.linalg.norm(x_n, axis=0)
+        done = np.isnan( x_n.sum(axis=0) ) | (n_x_n < prec)
+        if done.any():      # store finished columns, and remove them
+            X[:,active[done]] = x_n[:,done]
+            T1[:,active[done]] = tmp1[:,done]
+            T2[:,active[done]] = tmp2[:,done]
+            comp[active[done]] = n
+            keep = ~done
+            active = active[keep]
+            if len(active) == 0:
+                break
+            x_n, x_n_old, tmp1, tmp2 = x_n[:,keep], x_n_old[:,keep], tmp1[:,keep], tmp2[:,keep]
+            y, eta, a = y[:,keep], eta[keep], a[keep]
+        x_n_old[:,:] = x_n[:,:]
+    if len(active) > 0:     # not converged within nbiter
+        X[:,active] = x_n
+        T1[:,active] = tmp1
+        T2[:,active] = tmp2
+        comp[active] = max(nbiter-1, 0)
+    #  3 - eliminate scaling step
+    X *= scale
+    if full_state:
+        return X, comp, (X, T1*scale, T2*scale)
+    return X, comp
+
+class WoodburyBinv(object):
+    r"""
+    applies inv(Id + K.t K) without building it, using the Woodbury identity
+        inv(Id_N + K.t K) = Id_N - K.t inv(Id_M + K K.t) K
+    only the small MxM matrix inv(Id_M + K K.t) is computed and stored,
+    and Binv.dot(v) costs O(MN) instead of O(N^2) for the dense NxN matrix
+    used in place of the dense Binv, as it provides the same dot() method
+    """
+    def __init__(self, K, S=None):
+        "K the MxN transform matrix, S the precomputed inv(Id_M + K K.t) if available"
+        self.K = K
+        M, N = K.shape
+        if S is None:
+            S = np.linalg.inv(np.identity(M) + np.dot(K, K.T))
+        self.S = S
+        self.shape = (N, N)
+    def dot(self, v):
+        "returns inv(Id + K.t K) v - v being a vector or a block of columns"
+        return v - np.dot(self.K.T, np.dot(self.S, np.dot(self.K, v)))
+    def todense(self):
+        "returns the equivalent dense NxN matrix"
+        return self.dot(np.identity(self.shape[0]))
+
 def eval_dosy_noise(x, window_size=9, order=3):
     """
     we estimate the noise in x by computing difference from polynomial fitting
@@ -448,7 +552,53 @@ def process(param):
         lchi2 = 0
     return (icol, c, lchi2)
 
-def do_palma(npkd, miniSNR=32, mppool=None, nbiter=1000, lamda=0.1, uncertainty=1.2, precision=1E-8):
+def _palma_columns(arrays, icols, nbiter, lamda, precision, uncertainty):
+    """
+    processes the columns icols of arrays['buffer'], results go to arrays['output'], arrays['chi2'] and arrays['comp']
+    icols is either an index array, processed with palma_block(),
+    or a list of runs of contiguous columns, processed with warm starts by palma_runs()
+    """
+    K = arrays['K']
+    if 'S' in arrays:
+        Binv = WoodburyBinv(K, S=arrays['S'])
+    else:
+        Binv = arrays['Binv']
+    if isinstance(icols, list):
+        icols, X, comp = palma_runs(K, Binv, arrays['buffer'], icols, nbiter=nbiter, uncertainty=uncertainty, lamda=lamda,
+                                    precision=precision)
+        Y = arrays['buffer'][:,icols]
+    else:
+        Y = arrays['buffer'][:,icols]
+        X, eta, comp = palma_block(K, Binv, Y, nbiter=nbiter, uncertainty=uncertainty, lamda=lamda, precision=precision)
+    arrays['output'][:,icols] = X
+    arrays['chi2'][icols] = np.linalg.norm(Y-np.dot(K,X), axis=0)
+    arrays['comp'][icols] = comp
+    return len(icols)
+
+def _palma_chunk(task):
+    """
+    do the processing of a chunk of columns, used by do_palma() loops - possibly in another process
+    arrays is a dict holding 'buffer', 'output', 'chi2', 'comp', 'K' and either 'Binv' or 'S' (see WoodburyBinv)
+    either as numpy arrays, or as the (name, shape) of the shared memory blocks holding them
+    only the column indices icols (or runs of indices, see _palma_columns()) travel with each task
+    """
+    arrays, icols, nbiter, lamda, precision, uncertainty = task
+    if not isinstance(arrays['buffer'], tuple):
+        return _palma_columns(arrays, icols, nbiter, lamda, precision, uncertainty)
+    from spike.util.sharedmem import attach
+    shms = []
+    attached = {}
+    for key, (name, shape) in arrays.items():
+        shm = attach(name)      # owned by the calling process, which unlinks it
+        shms.append(shm)
+        attached[key] = np.ndarray(shape, dtype=float, buffer=shm.buf)
+    done = _palma_columns(attached, icols, nbiter, lamda, precision, uncertainty)
+    del attached        # the buffers should be released before closing
+    for shm in shms:
+        shm.close()
+    return done
+
+def do_palma(npkd, miniSNR=32, mppool=None, nbiter=1000, lamda=0.1, uncertainty=1.2, precision=1E-8, batch=64, warm=0):
     """
     realize PALMA computation on each column of the 2D datasets
     dataset should have been prepared with prepare_palma()
@@ -458,12 +608,23 @@ def do_palma(npkd, miniSNR=32, mppool=None, nbiter=1000, lamda=0.1, uncertainty=
 
     miniSNR: determines the minimum Signal to Noise Ratio of the signal for allowing the processing
     mppool: if passed as a multiprocessing.Pool, it will be used for parallel processing
+        the data, the matrices and the result are then placed in shared memory,
+        and workers only receive the indices of the columns to process
+    batch: the columns are processed by blocks of batch columns with palma_block(),
+        each block being iterated at once - 0 processes each column with palma()
+    warm: if > 0 (and batch > 0), columns are processed along F2 in runs of at most warm contiguous columns,
+        each column starting from the converged state of its neighbour (see palma_runs()) - this saves iterations
+    the number of iterations of each column is stored in output.axis1.comp, along with output.axis1.chi2
     
     the other parameters are transparently passed to palma()
 
     """
     import multiprocessing as mp
-    import itertools
+    from multiprocessing.pool import ThreadPool
+    try:
+        from itertools import imap
+    except ImportError:
+        imap = map
     from spike.util import progressbar as pg
     from spike.util import widgets
     # local functions
@@ -484,6 +645,7 @@ def do_palma(npkd, miniSNR=32, mppool=None, nbiter=1000, lamda=0.1, uncertainty=
         paral = False
     npkd.check2D()
     K = npkd.axis1.K
+    Binv = npkd.axis1.Binv
     M,N = K.shape
     output = npkd.copy()
     output.chsize(sz1=N)
@@ -491,63 +653,110 @@ def do_palma(npkd, miniSNR=32, mppool=None, nbiter=1000, lamda=0.1, uncertainty=
     noise = spike.util.signal_tools.findnoiselevel(npkd.row(0).get_buffer())
     valmini = noise*miniSNR
     # loop
-    xarg = palmaiter(npkd)
     wdg = ['PALMA: ', widgets.Percentage(), ' ', widgets.Bar(marker='-',left='[',right=']'), widgets.ETA()]
     pbar= pg.ProgressBar(widgets=wdg, maxval=npkd.size2).start() #, fd=sys.stdout)
-    if paral:
-        result = mppool.imap(process, xarg)
+    if batch > 0:
+        buf = npkd.get_buffer()
+        todo = np.flatnonzero(buf[0] > valmini)
+        if warm > 0:    # split into runs of contiguous columns, each run being cut into pieces of at most warm columns
+            runs = [r[i:i+warm] for r in np.split(todo, np.flatnonzero(np.diff(todo) > 1)+1) for i in range(0, len(r), warm)]
+            runs = [runs[i] for i in np.random.permutation(len(runs))]   # randomized, for a cleaner progress bar
+            chunks = []
+            for r in runs:      # about batch columns per chunk
+                if not chunks or sum(len(c) for c in chunks[-1]) + len(r) > max(batch, warm):
+                    chunks.append([])
+                chunks[-1].append(r)
+        else:
+            todo = np.random.permutation(todo)   # randomized, for a cleaner progress bar
+            chunks = [todo[i:i+batch] for i in range(0, len(todo), batch)]
+        outbuf = output.get_buffer()
+        outbuf[:,:] = 0.0           # columns below valmini are left empty
+        comp = np.zeros(npkd.size2)
+        arrays = {'buffer': buf, 'output': outbuf, 'chi2': chi2, 'comp': comp, 'K': K}
+        if isinstance(Binv, WoodburyBinv):
+            arrays['S'] = Binv.S
+        else:
+            arrays['Binv'] = Binv
+        shared = paral and not isinstance(mppool, ThreadPool)     # processes do not share memory
+        shms = {}
+        if shared:      # everything is copied once into shared memory
+            from multiprocessing import shared_memory
+            for key, a in arrays.items():
+                shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+                sa = np.ndarray(a.shape, dtype=float, buffer=shm.buf)
+                sa[...] = a
+                shms[key] = (shm, sa)
+            source = dict( (key, (shm.name, sa.shape)) for (key, (shm, sa)) in shms.items() )
+        else:
+            source = arrays
+        xarg = [(source, c, nbiter, lamda, precision, uncertainty) for c in chunks]
+        try:
+            if paral:
+                result = mppool.imap_unordered(_palma_chunk, xarg)
+            else:
+                result = imap(_palma_chunk, xarg)
+            # collect
+            ii = npkd.size2 - len(todo)
+            for done in result:
+                ii += done
+                pbar.update(ii)
+                sys.stdout.flush()
+            if shared:
+                outbuf[...] = shms['output'][1]
+                chi2[...] = shms['chi2'][1]
+                comp[...] = shms['comp'][1]
+        finally:
+            for key in list(shms.keys()):
+                shm, sa = shms.pop(key)
+                del sa
+                shm.close()
+                shm.unlink()
     else:
-        result = itertools.imap(process, xarg)
-    # collect
-    for ii, res in enumerate(result):
-        # if icol%50 == 0 :
-        #     print ("DOSY # %d / %d"%(icol,npkd.size2))
-        pbar.update(ii+1)
-        sys.stdout.flush()
-        icol, c, lchi2 = res
-        chi2[icol] = lchi2
-        output.set_col(icol, c)                                                                                                         
-    
-    # for icol in range(npkd.size2):
-    #     #if icol%10 ==0: print (icol, "iteration")
-    #     c = npkd.col(icol)
-    #     if (c[0] > miniSNR*noise):
-    #         y = c.get_buffer()
-    #         c = c.palma(N, nbiter=nbiter, lamda!!, precision=precision, uncertainty=uncertainty)
-    #         chi2[icol] = np.linalg.norm(y-np.dot(K,c.get_buffer()))
-    #     else:
-    #         c = c.set_buffer(np.zeros(N))
-    #     result.set_col(icol, c)                                                                                                         
+        xarg = palmaiter(npkd)
+        if paral:
+            result = mppool.imap(process, xarg)
+        else:
+            result = imap(process, xarg)
+        # collect
+        for ii, res in enumerate(result):
+            # if icol%50 == 0 :
+            #     print ("DOSY # %d / %d"%(icol,npkd.size2))
+            pbar.update(ii+1)
+            sys.stdout.flush()
+            icol, c, lchi2 = res
+            chi2[icol] = lchi2
+            output.set_col(icol, c)                                                                                                         
     pbar.finish()
     output.axis1.chi2 = chi2
+    if batch > 0:
+        output.axis1.comp = comp.astype(int)
+        print ("PALMA: %d iterations for %d columns"%(comp.sum(), len(todo)))
 
     return output
 
 
-def prepare_palma(npkd, finalsize, Dmin, Dmax):
+def compute_palma_matrices(qvalues, dfactor, N, Dmin, Dmax, solver='dense'):
     """
-    this method prepares a DOSY dataset for processing
-    - computes experimental values from imported parameter file
-    - prepare DOSY transformation matrix
+    computes the DOSY transformation matrix K and inv(Id + K.t K) used by PPXA+
+    returns (K, Binv), Binv being a dense matrix or a WoodburyBinv operator, depending on solver
     """
-    npkd.check2D()
-    M = npkd.size1
-    N = finalsize
+    M = len(qvalues)
     # computes t / direct space sampling
-    t = npkd.axis1.qvalues**2
-    t /= npkd.axis1.dfactor
+    t = np.asarray(qvalues, dtype=float)**2
+    t /= dfactor
     t = t.reshape((M,1))
     # compute T / Laplace space sampling
-    npkd.axis1.dmin = Dmin
-    npkd.axis1.dmax = Dmax
     targetaxis = LaplaceAxis(size=N)
     targetaxis.dmin = Dmin
     targetaxis.dmax = Dmax
     T = targetaxis.itod( np.arange(N) )
     T = T.reshape((1,N))
     K = np.exp(-np.kron(t, T))
-    npkd.axis1.K = K
 
+    if solver == 'woodbury':
+        return K, WoodburyBinv(K)
+    elif solver != 'dense':
+        raise Exception("solver should be either 'dense' or 'woodbury'")
     #Stepsize parameter 
     Kt = np.transpose(K)
     KtK = np.dot(Kt,K)
@@ -556,8 +765,89 @@ def prepare_palma(npkd, finalsize, Dmin, Dmax):
     B = np.identity(N)
     B = B + KtK
     Binv = np.linalg.inv(B)
-    npkd.axis1.Binv = Binv
+    return K, Binv
+
+def palma_key(qvalues, dfactor, N, Dmin, Dmax, solver='dense'):
+    "the content key of the PALMA matrices - qvalues enter through their digest"
+    q = np.ascontiguousarray(qvalues, dtype=float)
+    return (hashlib.sha1(q.tobytes()).hexdigest(), float(dfactor), int(N), float(Dmin), float(Dmax), solver)
 
+def palma_cachefile(cachedir, key):
+    "the file in which the matrices with key are stored in cachedir"
+    return op.join(cachedir, "palma_%s.npz"%hashlib.sha1(repr(key).encode()).hexdigest()[:16])
+
+_PALMA_MATRICES = {}    # in-process cache of the (K, Binv), keyed by palma_key()
+def cached_palma_matrices(key, cachedir=None):
+    """
+    returns the (K, Binv) stored for key, in memory or on disk in cachedir - None if not found
+    a matrix loaded from disk is kept in memory, so that each process reads it only once
+    """
+    mats = _PALMA_MATRICES.get(key)
+    if mats is None and cachedir is not None:
+        fname = palma_cachefile(cachedir, key)
+        if op.exists(fname):
+            with np.load(fname) as F:
+                K = F['K']
+                if key[-1] == 'woodbury':
+                    Binv = WoodburyBinv(K, S=F['S'])
+                else:
+                    Binv = F['Binv']
+            mats = _store_palma_matrices(key, K, Binv)
+    return mats
+
+def _store_palma_matrices(key, K, Binv):
+    "keeps (K, Binv) in the memory cache, as read-only arrays, as they are shared by all datasets"
+    K.flags.writeable = False
+    if isinstance(Binv, WoodburyBinv):
+        Binv.S.flags.writeable = False
+    else:
+        Binv.flags.writeable = False
+    _PALMA_MATRICES[key] = (K, Binv)
+    return (K, Binv)
+
+def palma_matrices(qvalues, dfactor, N, Dmin, Dmax, solver='dense', cachedir=None):
+    """
+    returns (K, Binv) as computed by compute_palma_matrices()
+    matrices are cached in memory, and if cachedir is given, on disk in cachedir as well
+    so that a series of DOSY acquired with the same sequence computes them only once
+    """
+    key = palma_key(qvalues, dfactor, N, Dmin, Dmax, solver)
+    mats = cached_palma_matrices(key, cachedir)
+    if mats is None:
+        K, Binv = compute_palma_matrices(qvalues, dfactor, N, Dmin, Dmax, solver)
+        if cachedir is not None:     # written to a temporary file first, as several processes may share cachedir
+            if not op.isdir(cachedir):
+                os.makedirs(cachedir, exist_ok=True)
+            fname = palma_cachefile(cachedir, key)
+            tmp = "%s.%d.tmp"%(fname, os.getpid())
+            with open(tmp, 'wb') as F:
+                if solver == 'woodbury':
+                    np.savez(F, K=K, S=Binv.S)
+                else:
+                    np.savez(F, K=K, Binv=Binv)
+            os.replace(tmp, fname)
+        mats = _store_palma_matrices(key, K, Binv)
+    return mats
+
+def prepare_palma(npkd, finalsize, Dmin, Dmax, solver='dense', cachedir=None):
+    """
+    this method prepares a DOSY dataset for processing
+    - computes experimental values from imported parameter file
+    - prepare DOSY transformation matrix
+    solver determines how inv(Id + K.t K) is applied during iterations
+        'dense'    : the NxN matrix is computed and stored
+        'woodbury' : a WoodburyBinv operator is used, which only inverts a MxM matrix - faster when M << N
+    matrices are shared by all datasets with the same qvalues, dfactor, finalsize, Dmin and Dmax,
+        they are cached in memory, and on disk in cachedir if given - see palma_matrices()
+    """
+    npkd.check2D()
+    npkd.axis1.dmin = Dmin
+    npkd.axis1.dmax = Dmax
+    K, Binv = palma_matrices(npkd.axis1.qvalues, npkd.axis1.dfactor, finalsize, Dmin, Dmax, solver=solver, cachedir=cachedir)
+    if K.shape[0] != npkd.size1:
+        raise Exception("Size missmatch in prepare_palma : %d qvalues while data is %d x %d" % (K.shape[0], npkd.size1, npkd.size2))
+    npkd.axis1.K = K
+    npkd.axis1.Binv = Binv
     return npkd
 
 
@@ -610,8 +900,143 @@ def palma(npkd, N, nbiter=1000, uncertainty=1.0, lamda=0.1, precision=1E-8, full
         print ("%d NaN conditions encountered during PALMA processing"%NaN_found)
     return npkd
 
+def palma_block(K, Binv, Y, nbiter=1000, uncertainty=1.0, lamda=0.1, precision=1E-8, init=None, full_state=False):
+    """
+    realize PALMA computation on a (M, B) block Y of B decays - the batched version of palma()
+    noise is estimated on each column, then PPXAplus_batch() is applied on all of them
+    columns producing NaN are processed again with an increased uncertainty, as in palma(), and without init
+    init and full_state are passed to PPXAplus_batch()
+    returns (X, eta, comp)
+        X the (N, B) block of computed images, eta the noise used for each column
+        comp the number of iterations of each column
+    or (X, eta, comp, state) if full_state is True
+    """
+    M, N = K.shape
+    if Y.shape[0] != M:
+        raise Exception("Size missmatch in palma_block : %d x %d  while data is %d x %d" % (M, N, Y.shape[0], Y.shape[1]))
+    B = Y.shape[1]
+    evald_noise = np.array([eval_dosy_noise(Y[:,i]) for i in range(B)])
+    uncert = uncertainty*np.ones(B)
+    X = np.zeros((N,B))
+    T1 = np.zeros((N,B))
+    T2 = np.zeros((M,B))
+    comp = np.zeros(B, dtype=int)
+    todo = np.arange(B)
+    NaN_found = 0
+    while len(todo) > 0:  # this is to force positivity or not NaN
+        eta = uncert[todo]*np.sqrt(M)*evald_noise[todo]
+        x, c, state = PPXAplus_batch(K, Binv, Y[:,todo], eta, nbiter=nbiter, lamda=lamda, prec=precision,
+                                     init=init, full_state=True)
+        init = None
+        X[:,todo] = x
+        T1[:,todo] = state[1]
+        T2[:,todo] = state[2]
+        comp[todo] = c
+        bad = np.isnan( x.sum(axis=0) )  #  the current algo sometimes produces NaN values
+        NaN_found += bad.sum()
+        todo = todo[bad]
+        uncert[todo] *= 1.4
+    if NaN_found >0:
+        print ("%d NaN conditions encountered during PALMA processing"%NaN_found)
+    if full_state:
+        return X, uncert*np.sqrt(M)*evald_noise, comp, (X, T1, T2)
+    return X, uncert*np.sqrt(M)*evald_noise, comp
+
+def palma_runs(K, Binv, buff, runs, nbiter=1000, uncertainty=1.0, lamda=0.1, precision=1E-8):
+    """
+    warm-started PALMA computation on the columns of the (M, C) buffer buff listed in runs
+    runs is a list of index arrays, each one a run of contiguous columns along F2
+    the first column of each run starts from a flat image, then each following column starts
+    from the converged state (image and PPXA+ auxiliary variables) of the previous one,
+    as neighbouring columns of a peak have nearly identical diffusion profiles
+    runs are processed in lockstep, the kth columns of all runs in a single palma_block() call
+    returns (icols, X, comp) with icols = np.concatenate(runs), X the (N, len(icols)) computed images
+        and comp the number of iterations of each column
+    """
+    M, N = K.shape
+    icols = np.concatenate(runs)
+    lengths = np.array([len(r) for r in runs])
+    starts = np.cumsum(lengths) - lengths
+    X = np.zeros((N, len(icols)))
+    comp = np.zeros(len(icols), dtype=int)
+    state = (np.zeros((N, len(runs))), np.zeros((N, len(runs))), np.zeros((M, len(runs))))
+    for k in range(lengths.max()):
+        lanes = np.flatnonzero(lengths > k)
+        pos = starts[lanes] + k
+        if k == 0:
+            init = None
+        else:   # profiles are similar along the run, but intensities vary, so the state follows the first point of the decay
+            ratio = buff[0,icols[pos]] / buff[0,icols[pos-1]]
+            init = tuple(s[:,lanes]*ratio for s in state)
+        x, eta, c, st = palma_block(K, Binv, buff[:,icols[pos]], nbiter=nbiter, uncertainty=uncertainty, lamda=lamda,
+                                    precision=precision, init=init, full_state=True)
+        X[:,pos] = x
+        comp[pos] = c
+        for s, v in zip(state, st):
+            s[:,lanes] = v
+    return icols, X, comp
+
 def test(npkd):
     print('Not implemented')
+
+class PALMA_Tests(unittest.TestCase):
+    "tests on a synthetic set of decays"
+    def setUp(self):
+        M, N, B = 20, 64, 12
+        t = np.linspace(0.001, 0.05, M).reshape((M,1))
+        T = np.logspace(1, 4, N).reshape((1,N))
+        self.K = np.exp(-np.kron(t, T))
+        self.Binv = np.linalg.inv(np.identity(N) + np.dot(self.K.T, self.K))
+        rng = np.random.RandomState(123)
+        D = 10**rng.uniform(1.5, 3.5, B)
+        self.Y = (1+rng.rand(B))*np.exp(-t*D) + 0.01*rng.randn(M,B)
+    def test_batch(self):
+        "PPXAplus_batch() gives the same images and iterations as PPXAplus()"
+        eta = 0.01*np.sqrt(self.K.shape[0])*np.ones(self.Y.shape[1])
+        X, comp = PPXAplus_batch(self.K, self.Binv, self.Y, eta, nbiter=500, lamda=0.05, prec=1E-8)
+        for i in range(self.Y.shape[1]):
+            x, c = PPXAplus(self.K, self.Binv, self.Y[:,i:i+1], eta[i], nbiter=500, lamda=0.05, prec=1E-8)
+            self.assertEqual(c, comp[i])
+            self.assertTrue(np.allclose(x[:,0], X[:,i], atol=1E-8*abs(x).max()))
+    def test_woodbury(self):
+        "WoodburyBinv matches the dense inverse, and gives the same images"
+        W = WoodburyBinv(self.K)
+        self.assertTrue(np.allclose(W.todense(), self.Binv, atol=1E-10))
+        v = np.random.randn(self.K.shape[1], 3)
+        self.assertTrue(np.allclose(W.dot(v), np.dot(self.Binv, v), atol=1E-10))
+        eta = 0.01*np.sqrt(self.K.shape[0])*np.ones(self.Y.shape[1])
+        X, comp = PPXAplus_batch(self.K, self.Binv, self.Y, eta, nbiter=500, lamda=0.05, prec=1E-8)
+        XW, compW = PPXAplus_batch(self.K, W, self.Y, eta, nbiter=500, lamda=0.05, prec=1E-8)
+        self.assertTrue(np.allclose(X, XW, atol=1E-6*abs(X).max()))
+    def test_warm(self):
+        "palma_runs() needs fewer iterations than palma_block() on a peak, for the same images"
+        M = self.K.shape[0]
+        t = np.linspace(0.001, 0.05, M).reshape((M,1))
+        rng = np.random.RandomState(12)
+        width = np.linspace(-3, 3, 10)
+        buff = np.exp(-t*300.0)*(1/(1+width**2)) + 0.002*rng.randn(M, 10)
+        X, eta, comp = palma_block(self.K, self.Binv, buff, nbiter=5000, lamda=0.05, precision=1E-7)
+        icols, XW, compW = palma_runs(self.K, self.Binv, buff, [np.arange(5), np.arange(5,10)], nbiter=5000, lamda=0.05, precision=1E-7)
+        self.assertTrue(np.array_equal(icols, np.arange(10)))
+        self.assertTrue(compW.sum() < comp.sum())
+        self.assertTrue(np.allclose(X, XW, atol=1E-3*abs(X).max()))
+        self.assertTrue(np.array_equal(compW[[0,5]], comp[[0,5]]))   # run starts are cold
+    def test_cache(self):
+        "palma_matrices() are computed once, and reloaded from disk"
+        import tempfile
+        q = np.linspace(2, 50, 16)
+        cachedir = tempfile.mkdtemp()
+        for solver in ('dense', 'woodbury'):
+            K, Binv = palma_matrices(q, 5E4, 64, 10.0, 1E4, solver=solver, cachedir=cachedir)
+            self.assertTrue(palma_matrices(q, 5E4, 64, 10.0, 1E4, solver=solver)[0] is K)
+            key = palma_key(q, 5E4, 64, 10.0, 1E4, solver)
+            del _PALMA_MATRICES[key]
+            K2, Binv2 = cached_palma_matrices(key, cachedir)
+            self.assertTrue(np.array_equal(K, K2))
+            self.assertTrue(np.array_equal(Binv.dot(K.T), Binv2.dot(K.T)))
+        Kref, Binvref = compute_palma_matrices(q, 5E4, 64, 10.0, 1E4)
+        self.assertTrue(np.allclose(Binvref, Binv.todense(), atol=1E-10))
+        self.assertTrue(cached_palma_matrices(palma_key(q, 5E4, 128, 10.0, 1E4)) is None)
 NPKData_plugin("palma", palma)
 NPKData_plugin("do_palma", do_palma)
 NPKData_plugin("prepare_palma", prepare_palma)
@@ -11,8 +11,8 @@ from numpy.fft import fft, ifft, rfft, irfft
 
 from spike.NPKData import NPKData_plugin,  as_cpx, as_float, _base_fft,\
             _base_ifft, _base_rfft, _base_irfft
-from spike.Algo.sane import sane
-from spike.util.signal_tools import filtering
+from spike.Algo.sane import sane, _sane_chunk
+from spike.util.signal_tools import filtering, findnoiselevel
 
 import sys #
 if sys.version_info[0] < 3:
@@ -20,7 +20,164 @@ if sys.version_info[0] < 3:
 else:
     xrange = range
 
-def sane_plugin(npkd, rank, orda=None, iterations=1, axis=0, trick=True, optk=False, ktrick=False):
+def _series_block(npkd, todo):
+    """
+    returns the (n, L) complex block holding all the 1D series of the 2D npkd along axis todo
+    - one series per row - as sane() would receive them from npkd.row(i) or npkd.col(i)
+    """
+    if todo == 2:
+        itype = npkd.axis2.itype
+        buf = npkd.buffer
+    else:
+        itype = npkd.axis1.itype
+        buf = npkd.buffer.T
+    if itype == 0:   # real, go to analytical signal, series by series
+        return np.array([as_cpx(_base_ifft(_base_rfft(v.copy()))) for v in buf])
+    block = np.empty((buf.shape[0], buf.shape[1]//2), dtype=complex)
+    block.real = buf[:, ::2]
+    block.imag = buf[:, 1::2]
+    return block
+
+def _set_series_block(npkd, todo, block, index=None):
+    """
+    stores in place into npkd the block of series, as returned by _series_block()
+    if index is given, block holds only the series listed in index
+    """
+    if todo == 2:
+        itype = npkd.axis2.itype
+        buf = npkd.buffer
+    else:
+        itype = npkd.axis1.itype
+        buf = npkd.buffer.T     # a view, so assignments go to npkd.buffer
+    if index is None:
+        index = np.arange(block.shape[0])
+    if itype == 0:   # real, comes back to real
+        for i, ii in enumerate(index):
+            buf[ii, :] = _base_irfft(_base_fft(as_float(block[i].copy())))
+    else:
+        buf[index, ::2] = block.real
+        buf[index, 1::2] = block.imag
+
+def _signal_series(block, miniSNR, screen='first'):
+    """
+    returns a boolean array, True for the series of block (one per row) which are above miniSNR times the noise
+    screen : 'first' the modulus of the first point of each series is compared to the noise level of the first points
+                     of all series, as computed by findnoiselevel() - this is the criterion used by do_palma()
+             'norm'  the rms of each series is compared to the noise level of the last points of all series
+    """
+    if screen == 'first':
+        noise = findnoiselevel(block[:, 0].real)
+        return abs(block[:, 0]) > miniSNR*noise
+    elif screen == 'norm':
+        noise = findnoiselevel(block[:, -1].real)*np.sqrt(2)        # complex noise
+        return np.sqrt((abs(block)**2).mean(axis=1)) > miniSNR*noise
+    raise Exception("screen should be either 'first' or 'norm'")
+
+def _series_seed(seed, i, shared_omega):
+    """
+    the seed of the ith series of a 2D, for sane() or sane_batch()
+    the same in all the code paths, so that a seeded result does not depend on batch, pool or workers
+    """
+    if seed is None or shared_omega:
+        return seed
+    return seed + i
+
+def sane_series(datasets, rank, orda=None, iterations=1, axis=0, trick=True, ktrick=False, batch=128, mppool=None, workers=0,
+                precision='double', threads=None, miniSNR=0, screen='first', skipped='keep', seed=None, shared_omega=False):
+    """
+    Apply "sane" denoising along axis to a list of 2D datasets, in place
+    All the series of the same length, coming from all the datasets, are denoised together by sane_batch(),
+    batch series at a time - so same-sized experiments from different samples share the stacked computation.
+
+    mppool: if passed as a multiprocessing.Pool, the chunks of batch series are distributed over it,
+        the series being held in shared memory, so that only their location is sent to the workers.
+        a multiprocessing.pool.ThreadPool is also accepted.
+    workers: if larger than 1 and mppool is None, the chunks are distributed over a pool of this many threads.
+    Each series draws its random projections from its own generator, seeded from the global numpy one - or from seed if given -
+    so the result is independent of batch and of the way the chunks are distributed.
+    seed: if given (an integer), the ith series of the datasets (counted over all of them, in order) is denoised
+        as sane() with rng=seed+i, as sane_plugin() does with batch=0, so the result is reproducible from run to run
+    shared_omega: if True, all the series of the same length use the same random projections (see sane_batch)
+    miniSNR: if > 0, the series below miniSNR times the noise level (see _signal_series() for the screen criterion)
+        contain only noise, they are not denoised, and are either kept as they are (skipped='keep') or zeroed (skipped='zero')
+
+    other parameters are as for sane_plugin()
+    returns the list of datasets
+    """
+    import multiprocessing as mp
+    from multiprocessing.pool import ThreadPool
+    if mppool is not None and not isinstance(mppool, mp.pool.Pool):
+        raise Exception("parameter mppool should be either None or of multiprocessing.Pool type")
+    pool = mppool
+    if pool is None and workers > 1:
+        pool = ThreadPool(workers)
+    shared = pool is not None and not isinstance(pool, ThreadPool)     # processes do not share memory
+    if skipped not in ('keep', 'zero'):
+        raise Exception("skipped should be either 'keep' or 'zero'")
+    kw = dict(orda=orda, iterations=iterations, trick=trick, ktrick=ktrick, precision=precision, threads=threads,
+              shared_omega=shared_omega)
+    groups = {}
+    first = 0               # the number of the first series of d, over all datasets
+    for d in datasets:
+        todo = d.test_axis(axis)
+        block = _series_block(d, todo)
+        index = np.arange(block.shape[0])
+        ids = first + index
+        first += block.shape[0]
+        if miniSNR > 0:
+            index = np.flatnonzero(_signal_series(block, miniSNR, screen))
+            if skipped == 'zero':
+                buf = d.buffer if todo == 2 else d.buffer.T
+                buf[np.setdiff1d(np.arange(block.shape[0]), index)] = 0.0
+            block = block[index]
+            ids = ids[index]
+        groups.setdefault(block.shape[1], []).append((d, todo, block, index, ids))
+    for members in groups.values():
+        stack = np.concatenate([block for (d, todo, block, index, ids) in members])
+        if stack.shape[0] == 0:                 # nothing left to denoise
+            continue
+        starts = range(0, stack.shape[0], batch)
+        if shared_omega:        # all chunks draw the same projections, as sane(rng=seed) would
+            seeds = [np.random.randint(2**31-1) if seed is None else seed]*len(starts)
+        else:                   # one seed per series
+            if seed is None:
+                series = np.random.randint(2**31-1, size=stack.shape[0])
+            else:
+                ids = np.concatenate([ids for (d, todo, block, index, ids) in members])
+                series = [_series_seed(seed, int(i), shared_omega) for i in ids]
+            seeds = [series[start:start+batch] for start in starts]
+        if shared:
+            from multiprocessing import shared_memory
+            shm = shared_memory.SharedMemory(create=True, size=stack.nbytes)
+            shstack = np.ndarray(stack.shape, dtype=complex, buffer=shm.buf)
+            shstack[...] = stack
+            source = shm.name
+        else:
+            source = stack
+        tasks = [(source, stack.shape, start, start+batch, seed, rank, kw) for (start, seed) in zip(starts, seeds)]
+        try:
+            if pool is None:
+                for task in tasks:
+                    _sane_chunk(task)
+            else:
+                pool.map(_sane_chunk, tasks)
+            if shared:
+                stack[...] = shstack
+        finally:
+            if shared:
+                del shstack
+                shm.close()
+                shm.unlink()
+        start = 0
+        for (d, todo, block, index, ids) in members:
+            _set_series_block(d, todo, stack[start:start+block.shape[0]], index)
+            start += block.shape[0]
+    if pool is not None and mppool is None:
+        pool.close()
+    return datasets
+
+def sane_plugin(npkd, rank, orda=None, iterations=1, axis=0, trick=True, optk=False, ktrick=False, batch=128, mppool=None, workers=0,
+                precision='double', threads=None, miniSNR=0, screen='first', skipped='keep', seed=None, shared_omega=False):
     """
     Apply "sane" denoising to data
     rank is about 2 x number_of_expected_lines
@@ -40,6 +197,20 @@ def sane_plugin(npkd, rank, orda=None, iterations=1, axis=0, trick=True, optk=Fa
     ktrick : if a value is given, it permits to change the rank on the second pass.
              The idea is that for the first pass a rank large enough as to be used to compensate for the noise while
              for the second pass a lower rank can be used. 
+    batch : in 2D, the number of rows or columns denoised together in a single stacked computation (see sane_batch)
+            if 0, rows or columns are processed one by one.
+    mppool : in 2D, if passed as a multiprocessing.Pool, the chunks of batch rows or columns are processed in parallel over it
+    workers : in 2D, if mppool is None, the number of threads used to process the chunks (see sane_series)
+    precision : either 'double' (default) or 'single' - single precision computes in complex64, which is faster and
+            lighter, and largely sufficient for spectra displayed in modulus and bucketed.
+    threads : the number of threads used by each FFT - default is set by spike.util.fftbackend.set_backend()
+            useful to use spare cores when fewer experiments than processors are processed
+    miniSNR : in 2D, if > 0, rows or columns containing only noise - below miniSNR times the noise level - are not denoised
+            screen chooses the criterion, either 'first' (first point, as do_palma) or 'norm' (rms of the series)
+            skipped tells what to do with them, either 'keep' them untouched or 'zero' them
+    seed : if given (an integer), the random projections are derived from it, making the result reproducible
+            in 2D, the ith row or column is denoised with the seed seed+i, so the result does not depend on batch
+    shared_omega : in 2D, if True, the same random projections are used for all rows or columns, which is faster
     
     """
     if npkd.dim == 1:
@@ -47,7 +218,8 @@ def sane_plugin(npkd, rank, orda=None, iterations=1, axis=0, trick=True, optk=Fa
             buff = as_cpx(_base_ifft(_base_rfft(npkd.buffer)))       # real case, go to analytical signal
         else:   #complex
             buff = npkd.get_buffer()                       # complex case, makes complex
-        sane_result = sane( buff, rank, orda = orda, trick = trick, iterations = iterations) # performs denoising
+        sane_result = sane( buff, rank, orda = orda, trick = trick, iterations = iterations, precision = precision, threads = threads, rng = seed) # performs denoising
+        sane_result = sane_result.astype(complex, copy=False)    # back to double precision
         if npkd.axis1.itype == 0:   # real
             buff = _base_irfft(_base_fft(as_float(sane_result)))      # real case, comes back to real
             npkd.set_buffer(buff)
@@ -55,18 +227,67 @@ def sane_plugin(npkd, rank, orda=None, iterations=1, axis=0, trick=True, optk=Fa
             npkd.buffer = as_float(sane_result)             # complex case, makes real
     elif npkd.dim == 2:
          todo = npkd.test_axis(axis)
-         if todo == 2:
-             for i in xrange(npkd.size1):
-                 r = npkd.row(i).sane(rank=rank, orda=orda, iterations=iterations)
-                 npkd.set_row(i,r)
-         elif todo == 1:
-             for i in xrange(npkd.size2):
-                 r = npkd.col(i).sane(rank=rank, orda=orda, iterations=iterations)
-                 npkd.set_col(i,r)
+         if batch:
+             sane_series([npkd], rank, orda=orda, iterations=iterations, axis=axis, trick=trick, ktrick=ktrick, batch=batch,
+                         mppool=mppool, workers=workers, precision=precision, threads=threads,
+                         miniSNR=miniSNR, screen=screen, skipped=skipped, seed=seed, shared_omega=shared_omega)
+         else:
+             if skipped not in ('keep', 'zero'):
+                 raise Exception("skipped should be either 'keep' or 'zero'")
+             buf = npkd.buffer if todo == 2 else npkd.buffer.T
+             if miniSNR > 0:     # same screening as sane_series()
+                 signal = _signal_series(_series_block(npkd, todo), miniSNR, screen)
+             else:
+                 signal = np.ones(buf.shape[0], dtype=bool)
+             for i in xrange(buf.shape[0]):
+                 if not signal[i]:
+                     if skipped == 'zero':
+                         buf[i] = 0.0
+                     continue
+                 if todo == 2:
+                     r = npkd.row(i).sane(rank=rank, orda=orda, iterations=iterations, precision=precision, threads=threads,
+                                          seed=_series_seed(seed, i, shared_omega))
+                     npkd.set_row(i,r)
+                 else:
+                     r = npkd.col(i).sane(rank=rank, orda=orda, iterations=iterations, precision=precision, threads=threads,
+                                          seed=_series_seed(seed, i, shared_omega))
+                     npkd.set_col(i,r)
     elif npkd.dim == 3:
          raise Exception("not implemented yet")
     return npkd
 
 
 
+class sane_plugin_Tests(unittest.TestCase):
+    def _data(self):
+        "a 2D with 8 rows of signal, the others containing only noise"
+        from spike.NMR import NMRData
+        np.random.seed(12)
+        x = np.arange(400)/400.0
+        block = 0.1*(np.random.randn(64, 400) + 1j*np.random.randn(64, 400))
+        sig = np.arange(0, 64, 8)
+        for i in sig:
+            block[i] += 10*np.exp(2j*np.pi*(30+i)*x - 3*x)
+        d = NMRData(buffer=np.zeros((64, 800)))
+        d.axis2.itype = 1
+        _set_series_block(d, 2, block)
+        return d, sig
+    def test_screen(self):
+        "screened series are kept or zeroed, whether processed by batch or one by one"
+        for skipped in ('keep', 'zero'):
+            results = []
+            for batch in (0, 16):
+                d, sig = self._data()
+                ref = d.copy()
+                d.sane(rank=6, orda=150, axis=2, batch=batch, miniSNR=30, skipped=skipped, seed=3)
+                noise = np.setdiff1d(np.arange(64), sig)
+                if skipped == 'keep':
+                    self.assertTrue(np.array_equal(d.buffer[noise], ref.buffer[noise]))
+                else:
+                    self.assertTrue(np.all(d.buffer[noise] == 0.0))
+                self.assertFalse(np.allclose(d.buffer[sig], ref.buffer[sig]))      # signal rows are denoised
+                results.append(d.buffer[sig])
+            self.assertTrue(np.allclose(results[0], results[1]))
+        self.assertRaises(Exception, self._data()[0].sane, rank=6, batch=0, skipped='nope')
+
 NPKData_plugin("sane", sane_plugin)
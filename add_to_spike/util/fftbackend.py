@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+A thin FFT layer, used by sane, and, within a using() block, by the NPKData processing (ft_sim, rfft, ...)
+
+backends are
+    'numpy'  : numpy.fft - single threaded, always computes in double precision
+    'scipy'  : scipy.fft - multithreaded with workers=, keeps single precision
+    'pyfftw' : pyFFTW, FFTW plans are cached - only if pyFFTW is installed
+
+main functions are
+    set_backend(name, threads)       chooses the backend and the default number of threads
+    fft, ifft, rfft, irfft           same calls as numpy.fft, with an additional threads parameter
+    next_fast_len(n)                 the smallest size >= n efficiently transformed
+    using(name, threads)             context manager routing the FFT of spike.NPKData through this layer,
+                                     the previous state is restored on exit
+
+the backend choice is global to the process, and using() patches the module spike.NPKData:
+this is safe with multiprocessing, but not between threads, see using()
+"""
+
+from __future__ import print_function, division
+import numpy as np
+import numpy.fft as npfft
+import sys
+import unittest
+from contextlib import contextmanager
+try:
+    import scipy.fft as spfft
+except ImportError:
+    spfft = None
+try:
+    import pyfftw
+    import pyfftw.interfaces.numpy_fft as fwfft
+except ImportError:
+    fwfft = None
+
+BACKENDS = ('numpy', 'scipy', 'pyfftw')
+_current = {'name': ('numpy' if spfft is None else 'scipy'), 'threads': 1}      # modified by set_backend()
+
+def available():
+    "returns the list of the backends available on this system"
+    avail = ['numpy']
+    if spfft is not None:
+        avail.append('scipy')
+    if fwfft is not None:
+        avail.append('pyfftw')
+    return avail
+
+def set_backend(name=None, threads=None):
+    """
+    chooses the FFT backend, name being one of BACKENDS, and the default number of threads used by each transform
+    None leaves the current value unchanged
+    returns the previous (name, threads), so that it can be restored
+    """
+    previous = (_current['name'], _current['threads'])
+    if name is not None:
+        if name not in BACKENDS:
+            raise Exception("FFT backend should be one of %s"%(", ".join(BACKENDS)))
+        if name not in available():
+            raise Exception("FFT backend %s is not installed"%name)
+        if name == 'pyfftw':
+            pyfftw.interfaces.cache.enable()        # plans are kept from call to call
+            pyfftw.interfaces.cache.set_keepalive_time(60)
+        _current['name'] = name
+    if threads is not None:
+        _current['threads'] = max(1, int(threads))
+    return previous
+
+def get_backend():
+    "returns the current (name, threads)"
+    return (_current['name'], _current['threads'])
+
+def _transform(fname, a, n, axis, threads):
+    "calls the transform fname of the current backend"
+    if threads is None:
+        threads = _current['threads']
+    name = _current['name']
+    if name == 'scipy':
+        return getattr(spfft, fname)(a, n=n, axis=axis, workers=threads)
+    elif name == 'pyfftw':
+        return getattr(fwfft, fname)(a, n=n, axis=axis, threads=threads)
+    return getattr(npfft, fname)(a, n=n, axis=axis)
+
+def fft(a, n=None, axis=-1, threads=None):
+    "complex FFT of a along axis - as numpy.fft.fft() - computed with threads threads (default from set_backend)"
+    return _transform('fft', a, n, axis, threads)
+
+def ifft(a, n=None, axis=-1, threads=None):
+    "inverse complex FFT of a along axis - as numpy.fft.ifft()"
+    return _transform('ifft', a, n, axis, threads)
+
+def rfft(a, n=None, axis=-1, threads=None):
+    "FFT of the real a along axis - as numpy.fft.rfft()"
+    return _transform('rfft', a, n, axis, threads)
+
+def irfft(a, n=None, axis=-1, threads=None):
+    "inverse of rfft() - as numpy.fft.irfft()"
+    return _transform('irfft', a, n, axis, threads)
+
+def next_regular(target):
+    """
+    Find the next regular number greater than or equal to target.
+    Regular numbers are composites of the prime factors 2, 3, and 5.
+    Also known as 5-smooth numbers or Hamming numbers, these are the optimal
+    size for inputs to FFTPACK.
+    borrowed from scipy.signals - used by SANE to regularise its sizes, and when scipy.fft is missing
+
+    Target must be a positive integer.
+    """
+    if target <= 6:
+        return target
+    # Quickly check if it's already a power of 2
+    if not (target & (target-1)):
+        return target
+    match = float('inf')  # Anything found will be smaller
+    p5 = 1
+    while p5 < target:
+        p35 = p5
+        while p35 < target:
+            # Ceiling integer division, avoiding conversion to float
+            # (quotient = ceil(target / p35))
+            quotient = -(-target // p35)
+            # Quickly find next power of 2 >= quotient
+            p2 = 2**((quotient - 1).bit_length())
+            N = p2 * p35
+            if N == target:
+                return N
+            elif N < match:
+                match = N
+            p35 *= 3
+            if p35 == target:
+                return p35
+        if p35 < match:
+            match = p35
+        p5 *= 5
+        if p5 == target:
+            return p5
+    if p5 < match:
+        match = p5
+    return match
+
+def next_fast_len(target):
+    """
+    returns the smallest size larger or equal to target which is efficiently transformed
+    """
+    if spfft is not None:
+        return spfft.next_fast_len(int(target))
+    return next_regular(int(target))
+
+@contextmanager
+def using(name=None, threads=None, module=None):
+    """
+    context manager - within the with block, the FFT use the backend name with threads threads,
+    and the FFT of module, spike.NPKData by default, go through this layer (ft_sim, rfft, ...)
+    None leaves the current backend or threads unchanged
+    the previous backend, threads and module FFT are restored on exit, so nothing leaks from one task to the next
+
+    not thread-safe: the backend and module.npfft are process-wide, so while the block runs,
+    the FFT of all the threads of the process go through it, and two threads with overlapping blocks
+    may restore each other's state in the wrong order.
+    Use it in the main thread or in separate processes (as the multiprocessing pool of Plasmodesma does),
+    or call fft(), rfft(), ... of this module with an explicit threads= from threaded code.
+    """
+    if module is None:
+        import spike.NPKData as module
+    previous = set_backend(name, threads)
+    previous_fft = module.npfft
+    module.npfft = sys.modules[__name__]
+    try:
+        yield
+    finally:
+        module.npfft = previous_fft
+        set_backend(*previous)
+
+class fftbackend_Tests(unittest.TestCase):
+    def test_backends(self):
+        "all available backends give the numpy results"
+        x = np.random.randn(4, 360) + 1j*np.random.randn(4, 360)
+        r = np.random.randn(3, 512)
+        previous = get_backend()
+        try:
+            for name in available():
+                set_backend(name, threads=2)
+                self.assertTrue(np.allclose(fft(x, axis=1), npfft.fft(x, axis=1)))
+                self.assertTrue(np.allclose(ifft(x, n=400, axis=0), npfft.ifft(x, n=400, axis=0)))
+                self.assertTrue(np.allclose(rfft(r), npfft.rfft(r)))
+                self.assertTrue(np.allclose(irfft(rfft(r, threads=1)), r))
+        finally:
+            set_backend(*previous)
+        self.assertRaises(Exception, set_backend, 'nope')
+    def test_using(self):
+        "using() routes the module FFT and restores the previous state"
+        import types
+        module = types.SimpleNamespace(npfft=npfft)
+        previous = get_backend()
+        with using(available()[-1], threads=3, module=module):
+            self.assertEqual(get_backend(), (available()[-1], 3))
+            self.assertTrue(module.npfft is sys.modules[__name__])
+        self.assertEqual(get_backend(), previous)
+        self.assertTrue(module.npfft is npfft)
+        try:
+            with using(threads=5, module=module):
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(get_backend(), previous)
+        self.assertTrue(module.npfft is npfft)
+    def test_next_fast_len(self):
+        "next_fast_len() returns larger sizes, regular ones are kept"
+        for n in (7, 341, 1000, 1025, 4097):
+            self.assertTrue(next_fast_len(n) >= n)
+            self.assertTrue(next_regular(n) >= n)
+        self.assertEqual(next_regular(325), 360)
+        self.assertEqual(next_fast_len(1024), 1024)
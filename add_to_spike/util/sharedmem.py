@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Helpers for the worker side of numpy arrays held in multiprocessing shared memory
+
+the blocks are created, registered to the resource tracker and unlinked by the calling process,
+workers only attach to them with attach(), and close them when done.
+
+Who tracks an attached block depends on how the worker was started:
+    - spawned, or forked after the caller started its resource tracker: the worker shares the tracker of the caller
+      attaching registers the block again, which is harmless, and the worker should not unregister it
+      (the caller would then unregister a block already gone when unlinking it, and the tracker reports a KeyError)
+    - forked before the caller started its tracker: the worker starts a tracker of its own when attaching,
+      the block has to be unregistered from it, otherwise it is unlinked when the worker exits
+"""
+
+from __future__ import print_function
+import os
+
+_OWN_TRACKER = {}       # pid : True if this process runs its own resource tracker
+
+def attach(name):
+    """
+    attaches to the shared memory block name, created by another process which owns it and unlinks it
+    returns the multiprocessing.shared_memory.SharedMemory, to be closed - not unlinked - by the caller
+    """
+    from multiprocessing import shared_memory, resource_tracker
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)       # python >= 3.13
+    except TypeError:
+        pass
+    pid = os.getpid()
+    if pid not in _OWN_TRACKER:     # no tracker yet in this process: attaching starts one, private to this process
+        _OWN_TRACKER[pid] = resource_tracker._resource_tracker._fd is None
+    shm = shared_memory.SharedMemory(name=name)
+    if _OWN_TRACKER[pid]:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm